@@ -0,0 +1,417 @@
+# benchmark.py
+# Measure ingestion and header throughput on synthetic blockchain files
+#
+# HingOn Miu
+
+# Blocks are generated deterministically from a seed, so runs on different machines
+# parse the same bytes. They are valid for the full node proxy and the spv client:
+#   every block links to the previous one and its merkle root commits to its transactions
+#   every header meets the easiest regtest target 0x207FFFFF, about two nonces per block
+#   headers are 700 seconds apart, so the retarget rule keeps the target at the limit
+#   inputs spend outputs of earlier transactions, outputs pay to P2PKH scripts
+#
+# Results are printed as one JSON object:
+#   python benchmark.py --blocks 2000 --txs 100 > result.json
+# Every stage runs in its own child process, so the peak resident memory of a stage
+# is not hidden by the generator or by an earlier stage.
+
+import os
+import sys
+import time
+import json
+import struct
+import random
+import hashlib
+import shutil
+import tempfile
+import resource
+import argparse
+import multiprocessing
+import blockchain
+import block_header
+import block_filter
+
+
+# easiest target, so synthetic blocks are mined in a couple of tries
+SYNTHETIC_NBITS = 0x207FFFFF
+
+# time of the first synthetic block, the genesis block time
+SYNTHETIC_START_TIME = 1231006505
+
+# seconds between synthetic blocks, more than the 600 second target spacing
+SYNTHETIC_BLOCK_SPACING = 700
+
+# largest blk*.dat file the node writes before starting the next one
+MAX_FILE_SIZE = 128 * 1024 * 1024
+
+# unspent outputs kept to be spent by later transactions
+MAX_UNSPENT_OUTPUTS = 100000
+
+
+def get_random_bytes(rng, size):
+	# deterministic random bytes
+	return b"".join([struct.pack("<Q", rng.getrandbits(64)) for i in xrange(0, (size + 7) / 8)])[:size]
+
+
+def generate_transaction(rng, unspent_outputs, input_count, output_count):
+	# raw transaction spending random unspent outputs to new P2PKH outputs
+	raw_tx = struct.pack("<I", 1) + blockchain.to_var_len_int(input_count)
+
+	for i in xrange(0, input_count):
+		# spend an earlier output, or a made-up one before there are enough
+		if len(unspent_outputs) > 0:
+			nth_output = rng.randrange(0, len(unspent_outputs))
+			outpoint = unspent_outputs[nth_output]
+			unspent_outputs[nth_output] = unspent_outputs[-1]
+			unspent_outputs.pop()
+		else:
+			outpoint = get_random_bytes(rng, 32) + struct.pack("<I", 0)
+
+		# signature and public key
+		script = get_random_bytes(rng, 107)
+		raw_tx += outpoint + blockchain.to_var_len_int(len(script)) + script + b"\xFF\xFF\xFF\xFF"
+
+	raw_tx += blockchain.to_var_len_int(output_count)
+	for i in xrange(0, output_count):
+		# OP_DUP OP_HASH160 <20 bytes> OP_EQUALVERIFY OP_CHECKSIG
+		script = b"\x76\xA9\x14" + get_random_bytes(rng, 20) + b"\x88\xAC"
+		raw_tx += struct.pack("<Q", rng.randrange(0, 100000000)) + blockchain.to_var_len_int(len(script)) + script
+
+	# locktime
+	raw_tx += struct.pack("<I", 0)
+
+	return raw_tx
+
+
+def generate_coinbase(height, output_count):
+	# raw coinbase transaction, the height in its script makes every coinbase txid unique
+	script = struct.pack("<BI", 4, height)
+	raw_tx = (struct.pack("<I", 1) + blockchain.to_var_len_int(1) + block_filter.NULL_OUTPOINT +
+			blockchain.to_var_len_int(len(script)) + script + b"\xFF\xFF\xFF\xFF")
+
+	raw_tx += blockchain.to_var_len_int(output_count)
+	for i in xrange(0, output_count):
+		script = b"\x76\xA9\x14" + hashlib.sha256(script).digest()[:20] + b"\x88\xAC"
+		raw_tx += struct.pack("<Q", 5000000000) + blockchain.to_var_len_int(len(script)) + script
+
+	return raw_tx + struct.pack("<I", 0)
+
+
+def mine_header(prev_hash, merkle_root, block_time):
+	# raw header with a nonce meeting the synthetic target
+	target = block_header.get_target(SYNTHETIC_NBITS)
+	header_start = struct.pack("<I", 1) + prev_hash + merkle_root + struct.pack("<II", block_time, SYNTHETIC_NBITS)
+
+	nonce = 0
+	while True:
+		header_bin = header_start + struct.pack("<I", nonce)
+		header_hash = hashlib.sha256(hashlib.sha256(header_bin).digest()).digest()
+		if int(header_hash[::-1].encode("hex"), 16) <= target:
+			return header_bin, header_hash
+
+		nonce += 1
+
+
+def generate_blockchain(directory_path, block_count, tx_count, min_inputs, max_inputs,
+						min_outputs, max_outputs, seed=0, max_file_size=MAX_FILE_SIZE, sample_size=1000):
+	# write block_count synthetic blocks of tx_count transactions to blk*.dat files
+	# and their headers to blockheaders.dat in directory_path
+	# returns a deterministic sample of txids to query
+	rng = random.Random(seed)
+
+	# outpoints of outputs not spent yet
+	# txid (32 bytes little endian) | output index (4 bytes little endian)
+	unspent_outputs = []
+
+	# reservoir sample of txids
+	sample_tx_hashes = []
+	tx_seen = 0
+
+	prev_hash = b"\x00" * 32
+	nth_file = 0
+	blockchain_dat = open(blockchain.get_filename(directory_path, nth_file), "wb")
+	blockheaders_dat = open(os.path.join(directory_path, blockchain.BLOCK_HEADERS_FILENAME), "wb")
+
+	try:
+		for height in xrange(0, block_count):
+			# coinbase first, then transactions with a random number of inputs and outputs
+			output_counts = [rng.randint(min_outputs, max_outputs) for i in xrange(0, tx_count)]
+			raw_txs = [generate_coinbase(height, output_counts[0])]
+			for i in xrange(1, tx_count):
+				raw_txs += [generate_transaction(rng, unspent_outputs, rng.randint(min_inputs, max_inputs),
+												output_counts[i])]
+
+			tx_hashes = []
+			for i in xrange(0, tx_count):
+				tx_hash = hashlib.sha256(hashlib.sha256(raw_txs[i]).digest()).digest()
+				tx_hashes += [tx_hash]
+
+				# outputs of this block can be spent by later blocks
+				for j in xrange(0, output_counts[i]):
+					if len(unspent_outputs) < MAX_UNSPENT_OUTPUTS:
+						unspent_outputs += [tx_hash + struct.pack("<I", j)]
+
+				# keep every txid with the same chance
+				tx_seen += 1
+				if len(sample_tx_hashes) < sample_size:
+					sample_tx_hashes += [tx_hash]
+				else:
+					nth_sample = rng.randrange(0, tx_seen)
+					if nth_sample < sample_size:
+						sample_tx_hashes[nth_sample] = tx_hash
+
+			header_bin, prev_hash = mine_header(prev_hash, blockchain.get_merkle_root(b"".join(tx_hashes)),
+											SYNTHETIC_START_TIME + height * SYNTHETIC_BLOCK_SPACING)
+
+			block = header_bin + blockchain.to_var_len_int(len(raw_txs)) + b"".join(raw_txs)
+
+			# node starts the next file once this one is full
+			if blockchain_dat.tell() > 0 and blockchain_dat.tell() + 8 + len(block) > max_file_size:
+				blockchain_dat.close()
+				nth_file += 1
+				blockchain_dat = open(blockchain.get_filename(directory_path, nth_file), "wb")
+
+			blockchain_dat.write(struct.pack("<II", blockchain.MAGIC_NUM, len(block)) + block)
+			blockheaders_dat.write(header_bin)
+	finally:
+		blockchain_dat.close()
+		blockheaders_dat.close()
+
+	return sample_tx_hashes
+
+
+def get_peak_rss():
+	# peak resident memory in bytes of this process and of its finished worker processes
+	# ru_maxrss is in kilobytes on Linux
+	return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+			resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+
+def run_stage(stage, *args):
+	# run a stage in a child process, returns its result and the peak rss of the child and its workers
+	# the child starts from this small process, so its peak is the stage's own
+	receiver, sender = multiprocessing.Pipe(False)
+
+	def run():
+		receiver.close()
+		result = stage(*args)
+		sender.send((result, get_peak_rss()))
+
+	child = multiprocessing.Process(target=run)
+	child.start()
+	sender.close()
+
+	try:
+		result, peak_rss = receiver.recv()
+	except EOFError:
+		# the child printed its traceback
+		raise RuntimeError("benchmark stage " + stage.__name__ + " failed")
+	finally:
+		child.join()
+
+	return result, peak_rss
+
+
+def set_peak_rss(stage_result, peak_rss):
+	# peak resident memory of a stage, and of its worker processes if it had any
+	stage_result["peak_rss_bytes"] = peak_rss[0]
+	if peak_rss[1] > 0:
+		stage_result["peak_worker_rss_bytes"] = peak_rss[1]
+
+	return stage_result
+
+
+def get_rates(seconds, block_count, tx_count, byte_count):
+	# throughput of a stage
+	seconds = max(seconds, 1e-9)
+	return {
+		"seconds": seconds,
+		"blocks_per_second": block_count / seconds,
+		"txs_per_second": tx_count / seconds,
+		"mb_per_second": byte_count / seconds / (1024 * 1024),
+	}
+
+
+def get_dat_size(directory_path):
+	# bytes of all blk*.dat files
+	return sum([os.path.getsize(blockchain.get_filename(directory_path, nth_file))
+				for nth_file in blockchain.get_file_numbers(directory_path)])
+
+
+def benchmark_parse(directory_path):
+	# parse every block and hash its transactions, without any index
+	# merkle trees of the parsed leaves are timed apart from parsing
+	block_count = 0
+	tx_count = 0
+	merkle_seconds = 0.0
+
+	start_time = time.time()
+	for record in blockchain.iter_blocks(directory_path):
+		block_count += 1
+		tx_count += record.tx_count
+
+		merkle_start_time = time.time()
+		blockchain.get_merkle_tree(record.tx_hashes)
+		merkle_seconds += time.time() - merkle_start_time
+
+	parse_seconds = time.time() - start_time - merkle_seconds
+
+	return parse_seconds, merkle_seconds, block_count, tx_count
+
+
+def benchmark_headers(blockheaders_filename):
+	# parse the headers file and link every header into the chain like a fresh spv client
+	block_header.reset()
+
+	start_time = time.time()
+	block_header.load_headers(blockheaders_filename)
+	load_seconds = time.time() - start_time
+
+	start_time = time.time()
+	longest_hash, longest_chain_height = block_header.compute_distances_bfs()
+	bfs_seconds = time.time() - start_time
+
+	return load_seconds, bfs_seconds, longest_chain_height
+
+
+def benchmark_ingest(directory_path, num_processes):
+	# build every index of the proxy from scratch
+	start_time = time.time()
+	blockchain.load_blockchain(directory_path, num_processes)
+
+	return time.time() - start_time
+
+
+def benchmark_proofs(directory_path, tx_hashes):
+	# merkle branches of sampled transactions, cold and then from the merkle tree cache
+	# the proxy opens the indexes load_blockchain wrote, like it does on a restart
+	blockchain.setup(directory_path)
+	blockchain.merkle_tree_cache.clear()
+
+	start_time = time.time()
+	for tx_hash in tx_hashes:
+		blockchain.get_transaction_merkle_tree(tx_hash)
+	cold_seconds = time.time() - start_time
+
+	start_time = time.time()
+	for tx_hash in tx_hashes:
+		blockchain.get_transaction_merkle_tree(tx_hash)
+	warm_seconds = time.time() - start_time
+
+	return cold_seconds, warm_seconds
+
+
+def run_benchmark(args):
+	# every file is written under one scratch directory, removed unless asked to keep it
+	work_directory = args.directory or tempfile.mkdtemp(prefix="spv_benchmark_")
+	directory_path = os.path.join(work_directory, "blocks") + os.sep
+	if not os.path.isdir(directory_path):
+		os.makedirs(directory_path)
+
+	# synthetic headers only meet the regtest proof of work limit
+	block_header.POW_LIMIT_NBITS = args.pow_limit
+
+	result = {
+		"config": {
+			"blocks": args.blocks,
+			"txs": args.txs,
+			"inputs": [args.min_inputs, args.max_inputs],
+			"outputs": [args.min_outputs, args.max_outputs],
+			"seed": args.seed,
+			"processes": args.processes,
+			"script_index": blockchain.BUILD_SCRIPT_INDEX,
+			"block_filters": blockchain.BUILD_BLOCK_FILTERS,
+		},
+		"stages": {},
+	}
+	stages = result["stages"]
+
+	# the proxy writes its indexes to the working directory
+	cwd = os.getcwd()
+	os.chdir(work_directory)
+
+	try:
+		print("Generate " + str(args.blocks) + " blocks in " + directory_path)
+		start_time = time.time()
+		sample_tx_hashes, peak_rss = run_stage(generate_blockchain, directory_path, args.blocks, args.txs,
+											args.min_inputs, args.max_inputs, args.min_outputs, args.max_outputs,
+											args.seed, args.file_size, args.proofs)
+		stages["generate"] = set_peak_rss({"seconds": time.time() - start_time}, peak_rss)
+
+		byte_count = get_dat_size(directory_path)
+		result["dat_bytes"] = byte_count
+
+		# parse and merkle tree timings come from one pass over the blocks
+		print("Parse blocks...")
+		(parse_seconds, merkle_seconds, block_count, tx_count), peak_rss = run_stage(benchmark_parse, directory_path)
+		stages["parse_block"] = set_peak_rss(get_rates(parse_seconds, block_count, tx_count, byte_count), peak_rss)
+		stages["get_merkle_tree"] = set_peak_rss(get_rates(merkle_seconds, block_count, tx_count, tx_count * 32),
+												peak_rss)
+
+		print("Ingest blocks...")
+		ingest_seconds, peak_rss = run_stage(benchmark_ingest, directory_path, args.processes)
+		stages["load_blockchain"] = set_peak_rss(get_rates(ingest_seconds, block_count, tx_count, byte_count), peak_rss)
+
+		print("Load block headers...")
+		(load_seconds, bfs_seconds, chain_height), peak_rss = run_stage(benchmark_headers,
+			os.path.join(directory_path, blockchain.BLOCK_HEADERS_FILENAME))
+		stages["load_headers"] = set_peak_rss(get_rates(load_seconds, block_count, 0, block_count * 80), peak_rss)
+		stages["compute_distances_bfs"] = set_peak_rss(get_rates(bfs_seconds, block_count, 0, block_count * 80),
+													peak_rss)
+		result["chain_height"] = chain_height
+
+		print("Build merkle proofs...")
+		(cold_seconds, warm_seconds), peak_rss = run_stage(benchmark_proofs, directory_path, sample_tx_hashes)
+		stages["merkle_proofs_cold"] = set_peak_rss({"seconds": cold_seconds,
+													"proofs_per_second": len(sample_tx_hashes) / max(cold_seconds, 1e-9)},
+													peak_rss)
+		stages["merkle_proofs_warm"] = set_peak_rss({"seconds": warm_seconds,
+													"proofs_per_second": len(sample_tx_hashes) / max(warm_seconds, 1e-9)},
+													peak_rss)
+
+		result["blocks"] = block_count
+		result["txs"] = tx_count
+
+		# this process only starts the stages
+		result["peak_rss_bytes"] = get_peak_rss()[0]
+	finally:
+		os.chdir(cwd)
+		blockchain.tx_index.index.close()
+		blockchain.block_index.index.close()
+		blockchain.script_index.index.close()
+		if not args.keep:
+			shutil.rmtree(work_directory)
+
+	return result
+
+
+def parse_args(argv):
+	parser = argparse.ArgumentParser(description="Measure ingestion and header throughput on synthetic blocks.")
+	parser.add_argument("--blocks", type=int, default=1000, help="number of blocks to generate")
+	parser.add_argument("--txs", type=int, default=50, help="transactions per block, including the coinbase")
+	parser.add_argument("--min-inputs", type=int, default=1, help="fewest inputs of a transaction")
+	parser.add_argument("--max-inputs", type=int, default=3, help="most inputs of a transaction")
+	parser.add_argument("--min-outputs", type=int, default=1, help="fewest outputs of a transaction")
+	parser.add_argument("--max-outputs", type=int, default=2, help="most outputs of a transaction")
+	parser.add_argument("--seed", type=int, default=0, help="seed of the block generator")
+	parser.add_argument("--file-size", type=int, default=MAX_FILE_SIZE, help="largest blk*.dat file in bytes")
+	parser.add_argument("--processes", type=int, default=1, help="worker processes of load_blockchain")
+	parser.add_argument("--proofs", type=int, default=1000, help="sampled transactions to build merkle proofs of")
+	parser.add_argument("--pow-limit", type=lambda value: int(value, 0), default=SYNTHETIC_NBITS,
+						help="proof of work limit nBits the spv client accepts")
+	parser.add_argument("--directory", default=None, help="scratch directory, a new temporary one by default")
+	parser.add_argument("--keep", action="store_true", help="keep the generated files")
+
+	return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+	# machine-readable results on stdout, progress of every module goes to stderr
+	stdout = sys.stdout
+	sys.stdout = sys.stderr
+	try:
+		result = run_benchmark(parse_args(sys.argv[1:]))
+	finally:
+		sys.stdout = stdout
+
+	print(json.dumps(result, indent=2, sort_keys=True))
@@ -0,0 +1,276 @@
+# block_filter.py
+# Compact block filters of Bitcoin blocks for wallet scanning
+#
+# HingOn Miu
+
+# https://github.com/bitcoin/bips/blob/master/bip-0158.mediawiki
+
+# A filter is a Golomb-coded set of the items of a block a wallet may look for:
+#   every output script, except empty and OP_RETURN scripts
+#   every spent outpoint, txid (32 bytes little endian) | output index (4 bytes little endian)
+# It uses the parameters of the BIP158 basic filter. The basic filter commits to
+# the scripts of spent outputs, which needs a UTXO set, so spent outpoints stand in.
+#
+# The filters file holds one record per block, in the order of the block headers file:
+#   block_hash (32 bytes little endian) | filter size (var int) | filter
+
+import os
+import struct
+import array
+
+
+# Golomb-Rice coding parameters of the BIP158 basic filter
+FILTER_P = 19
+FILTER_M = 784931
+
+# on-disk block filters
+FILTERS_FILENAME = "blockfilters.dat"
+
+# byte offset of the end of every record of the filters file
+filter_ends = array.array("L")
+
+# bytes of the filters file indexed into filter_ends
+filters_indexed = 0
+
+# outpoint spent by coinbase transactions, left out of filters
+NULL_OUTPOINT = b"\x00" * 32 + b"\xFF" * 4
+
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+
+def siphash(k0, k1, data):
+	# SipHash-2-4 of data, keyed by two 64 bit integers
+	v0 = k0 ^ 0x736F6D6570736575
+	v1 = k1 ^ 0x646F72616E646F6D
+	v2 = k0 ^ 0x6C7967656E657261
+	v3 = k1 ^ 0x7465646279746573
+
+	# whole 8 byte words, then the last bytes with the length in the top byte
+	length = len(data)
+	words_end = length - length % 8
+	last_word = (length & 0xFF) << 56
+	for i in xrange(words_end, length):
+		last_word |= ord(data[i]) << (8 * (i - words_end))
+
+	words = [struct.unpack_from("<Q", data, i)[0] for i in xrange(0, words_end, 8)] + [last_word]
+
+	# two compression rounds per word
+	for m in words:
+		v3 ^= m
+		for i in xrange(0, 2):
+			v0 = (v0 + v1) & MASK_64
+			v1 = ((v1 << 13) & MASK_64 | v1 >> 51) ^ v0
+			v0 = (v0 << 32) & MASK_64 | v0 >> 32
+			v2 = (v2 + v3) & MASK_64
+			v3 = ((v3 << 16) & MASK_64 | v3 >> 48) ^ v2
+			v0 = (v0 + v3) & MASK_64
+			v3 = ((v3 << 21) & MASK_64 | v3 >> 43) ^ v0
+			v2 = (v2 + v1) & MASK_64
+			v1 = ((v1 << 17) & MASK_64 | v1 >> 47) ^ v2
+			v2 = (v2 << 32) & MASK_64 | v2 >> 32
+		v0 ^= m
+
+	# four finalization rounds
+	v2 ^= 0xFF
+	for i in xrange(0, 4):
+		v0 = (v0 + v1) & MASK_64
+		v1 = ((v1 << 13) & MASK_64 | v1 >> 51) ^ v0
+		v0 = (v0 << 32) & MASK_64 | v0 >> 32
+		v2 = (v2 + v3) & MASK_64
+		v3 = ((v3 << 16) & MASK_64 | v3 >> 48) ^ v2
+		v0 = (v0 + v3) & MASK_64
+		v3 = ((v3 << 21) & MASK_64 | v3 >> 43) ^ v0
+		v2 = (v2 + v1) & MASK_64
+		v1 = ((v1 << 17) & MASK_64 | v1 >> 47) ^ v2
+		v2 = (v2 << 32) & MASK_64 | v2 >> 32
+
+	return v0 ^ v1 ^ v2 ^ v3
+
+
+def to_var_len_int(data):
+	# variable length integer: 1, 3, 5, or 9 bytes
+	if data < 0xFD:
+		return struct.pack("<B", data)
+	elif data <= 0xFFFF:
+		return b"\xFD" + struct.pack("<H", data)
+	elif data <= 0xFFFFFFFF:
+		return b"\xFE" + struct.pack("<I", data)
+	else:
+		return b"\xFF" + struct.pack("<Q", data)
+
+
+def parse_var_len_int(data, nth_byte):
+	# variable length integer: 1, 3, 5, or 9 bytes
+	first_byte = struct.unpack_from("<B", data, nth_byte)[0]
+	if first_byte < 0xFD:
+		return first_byte, 1
+	elif first_byte == 0xFD:
+		return struct.unpack_from("<H", data, nth_byte + 1)[0], 3
+	elif first_byte == 0xFE:
+		return struct.unpack_from("<I", data, nth_byte + 1)[0], 5
+	else:
+		return struct.unpack_from("<Q", data, nth_byte + 1)[0], 9
+
+
+def hash_to_range(block_hash, items, item_range):
+	# map items to integers in [0, item_range), keyed by the first 16 bytes of the block hash
+	k0, k1 = struct.unpack_from("<QQ", block_hash, 0)
+
+	return [(siphash(k0, k1, item) * item_range) >> 64 for item in items]
+
+
+def build_filter(block_hash, items):
+	# Golomb-coded set of the distinct items of a block
+	items = set(items)
+	item_count = len(items)
+
+	values = sorted(hash_to_range(block_hash, items, item_count * FILTER_M))
+
+	# Golomb-Rice code of every difference between sorted values, most significant bit first
+	filter_bytes = bytearray()
+	bits = 0
+	bit_count = 0
+	last_value = 0
+	for value in values:
+		delta = value - last_value
+		last_value = value
+
+		# quotient in unary, a one bit per multiple of 2^P and a closing zero bit,
+		# then the remainder in P bits
+		quotient = delta >> FILTER_P
+		code_length = quotient + 1 + FILTER_P
+		bits = (bits << code_length) | (((1 << quotient) - 1) << (FILTER_P + 1)) | (delta & ((1 << FILTER_P) - 1))
+		bit_count += code_length
+
+		# move whole bytes out of the bit buffer
+		while bit_count >= 8:
+			bit_count -= 8
+			filter_bytes.append((bits >> bit_count) & 0xFF)
+		bits &= (1 << bit_count) - 1
+
+	# pad the last byte with zero bits
+	if bit_count > 0:
+		filter_bytes.append((bits << (8 - bit_count)) & 0xFF)
+
+	return to_var_len_int(item_count) + bytes(filter_bytes)
+
+
+def match_filter(filter_data, block_hash, items):
+	# check if any of the items may be in the block, false positives happen once in M
+	item_count, num_byte_parsed = parse_var_len_int(filter_data, 0)
+	if item_count == 0 or len(items) == 0:
+		return False
+
+	# sorted values of the items to look for
+	query_values = sorted(hash_to_range(block_hash, items, item_count * FILTER_M))
+
+	# decode the set and walk it along the sorted query values
+	nth_bit = num_byte_parsed * 8
+	value = 0
+	nth_query = 0
+	for i in xrange(0, item_count):
+		# quotient in unary
+		quotient = 0
+		while (ord(filter_data[nth_bit >> 3]) >> (7 - (nth_bit & 7))) & 1:
+			quotient += 1
+			nth_bit += 1
+		nth_bit += 1
+
+		# remainder in P bits
+		remainder = 0
+		for j in xrange(0, FILTER_P):
+			remainder = (remainder << 1) | ((ord(filter_data[nth_bit >> 3]) >> (7 - (nth_bit & 7))) & 1)
+			nth_bit += 1
+
+		value += (quotient << FILTER_P) | remainder
+
+		# skip query values below this value of the set
+		while query_values[nth_query] < value:
+			nth_query += 1
+			if nth_query == len(query_values):
+				return False
+
+		if query_values[nth_query] == value:
+			return True
+
+	return False
+
+
+def pack_record(block_hash, filter_data):
+	# block_hash | filter size | filter
+	return block_hash + to_var_len_int(len(filter_data)) + filter_data
+
+
+def index_filters():
+	global filters_indexed
+
+	# record ends of filters appended since the last call
+	if not os.path.isfile(FILTERS_FILENAME):
+		return
+
+	# walk the record headers only, filters are skipped with seek
+	with open(FILTERS_FILENAME, "rb") as filters_dat:
+		file_size = os.fstat(filters_dat.fileno()).st_size
+
+		nth_byte = filters_indexed
+		while nth_byte + 32 + 1 <= file_size:
+			# filter size after the block hash, a var int of at most 9 bytes
+			filters_dat.seek(nth_byte + 32)
+			size_data = filters_dat.read(9)
+			if len(size_data) < {0xFD: 3, 0xFE: 5, 0xFF: 9}.get(ord(size_data[0]), 1):
+				break
+			filter_size, num_byte_parsed = parse_var_len_int(size_data, 0)
+			record_size = 32 + num_byte_parsed + filter_size
+
+			# record is still being written
+			if nth_byte + record_size > file_size:
+				break
+
+			nth_byte += record_size
+			filter_ends.append(nth_byte)
+
+	filters_indexed = nth_byte
+
+	return
+
+
+def reset_filters():
+	global filters_indexed
+
+	# filters file is about to be rewritten
+	del filter_ends[:]
+	filters_indexed = 0
+
+	return
+
+
+def get_filter_records(start_row, max_count):
+	# raw records of at most max_count filters from the nth block of the headers file
+	# take one length in case the sync thread appends during the read
+	record_count = len(filter_ends)
+	if start_row >= record_count:
+		return b""
+
+	end_row = min(start_row + max_count, record_count)
+	start_offset = filter_ends[start_row - 1] if start_row > 0 else 0
+	end_offset = filter_ends[end_row - 1]
+
+	with open(FILTERS_FILENAME, "rb") as filters_dat:
+		filters_dat.seek(start_offset)
+		return filters_dat.read(end_offset - start_offset)
+
+
+def parse_filter_records(data):
+	# list of (block hash, filter) of raw records
+	records = []
+
+	nth_byte = 0
+	while nth_byte < len(data):
+		block_hash = data[nth_byte: nth_byte + 32]
+		filter_size, num_byte_parsed = parse_var_len_int(data, nth_byte + 32)
+		nth_byte += 32 + num_byte_parsed
+
+		records += [(block_hash, data[nth_byte: nth_byte + filter_size])]
+		nth_byte += filter_size
+
+	return records
@@ -17,16 +17,15 @@ import time
 import struct
 import binascii
 import hashlib
+import collections
+import array
+import mmap
+import heapq
 
 
 # previous block hash of genesis block of bitcoin blockchain
-source_hash = "0000000000000000000000000000000000000000000000000000000000000000"
-
-# previous block header hash (little endian) to header
-prev_hash_to_block_headers = {}
-
-# previous block header hash (little endian) to current block header hash (little endian)
-curr_hash_to_prev_hash = {}
+# hashes are kept as raw 32 byte strings, hex is only used at the cli boundary
+source_hash = b"\x00" * 32
 
 # total number of blocks
 block_count = 0
@@ -35,127 +34,295 @@ block_count = 0
 blockchain_height = 0
 
 # block hash of latest block (little endian)
-latest_block_little = ""
+latest_block_little = b""
+
+# bytes of the headers file parsed into the store
+headers_consumed = 0
+
+# columnar header store, one row per block header in load order
+
+# raw 80 byte block headers
+raw_headers = bytearray()
+
+# SHA256(SHA256()) hash of each header (little endian), 32 bytes per row
+header_hashes = bytearray()
+
+# row of the previous block header, -1 if it is the genesis block or unknown
+prev_rows = array.array("i")
+
+# blockchain height of each block, -1 if it is not connected to the genesis block
+heights = array.array("i")
+
+# cumulative proof-of-work of the chain ending at each block, 32 bytes big endian per row
+chain_works = bytearray()
+
+# 1 if the block is in the main chain, 0 otherwise
+main_chain_flags = bytearray()
+
+# block header hash (little endian) to row
+# only holds rows added since the header cache was loaded
+curr_hash_to_row = {}
+
+# merkle root hash (little endian) to row
+# only holds rows added since the header cache was loaded
+merkle_root_to_row = {}
+
+# previous block hash (little endian) to rows not connected yet, waiting for that header
+# a header can reach the client before its previous header
+orphan_rows = {}
+
+# rows whose previous header is connected but whose time was too far ahead of the local clock
+# checked again with every batch of new headers, a slow clock must not drop them for good
+pending_rows = set()
+
+# verified transaction hash (little endian) to row of its block, least recently used first
+VERIFIED_TX_CACHE_SIZE = 100000
+verified_tx_cache = collections.OrderedDict()
+
+# header cache persisting the store and chain index between runs
+# an append-only log of column segments, a save only writes rows added or changed since the last one
+HEADER_CACHE_FILENAME = "headercache.dat"
+HEADER_CACHE_MAGIC = b"SPVH"
+HEADER_CACHE_VERSION = 3
+
+# magic | version | row count | tip row | bytes of headers file consumed | hash of last consumed header |
+# bytes of the log written | number of segments
+HEADER_CACHE_INFO = "<4sIIiQ32sQI"
+
+# each segment: first new row | number of new rows | number of changed rows,
+# followed by the columns of the new rows and the changed rows
+SEGMENT_INFO = "<III"
+
+# bytes per row of each column
+# raw header | hash | prev row | height | chain work | main chain flag
+COLUMN_SIZES = [80, 32, 4, 4, 32, 1]
+
+# row | prev row | height | chain work | main chain flag of a row changed after it was saved
+CHANGED_ROW_FORMAT = "<Iii32sB"
+
+# segments after which a save rewrites the log as a single segment
+HEADER_CACHE_MAX_SEGMENTS = 256
+
+# number of rows in the header cache log
+saved_row_count = 0
+
+# bytes and segments of the header cache log
+saved_log_end = 0
+saved_segment_count = 0
+
+# saved rows changed since, by headers connecting to them or by a reorg
+changed_rows = set()
+
+# sorted hash -> row and merkle root -> row indexes of the header cache
+# rows added since are kept in curr_hash_to_row and merkle_root_to_row until they are merged in
+HEADER_INDEX_FILENAME = "headerindex.dat"
+
+# row count | merkle root index count | hash of the last row, to check the index belongs to the store
+HEADER_INDEX_INFO = "<II32s"
+
+# rows added since the last merge after which a save merges them into the sorted indexes
+HEADER_INDEX_MERGE_SIZE = 100000
+
+# bytes of each sorted index record: hash (32 bytes) | row (4 bytes little endian)
+INDEX_RECORD_SIZE = 32 + 4
+
+# memory-mapped sorted indexes, searched in place
+header_index_data = None
+
+# number of rows covered by the sorted indexes
+cached_row_count = 0
+
+# number of distinct merkle roots in the sorted merkle root index
+cached_merkle_count = 0
+
+# byte offsets of the sorted hash and merkle root indexes
+cached_hash_index_start = 0
+cached_merkle_index_start = 0
+
+
+# easiest target a header may have, in compact nBits
+POW_LIMIT_NBITS = 0x1D00FFFF
 
-# block header hash (little endian) to header
-curr_hash_to_block_header = {}
+# blocks between difficulty retargets and the seconds they should take
+RETARGET_INTERVAL = 2016
+RETARGET_TIMESPAN = 14 * 24 * 60 * 60
 
-# merkle root hash (little endian) to block header hash (little endian)
-merkle_root_to_curr_hash = {}
+# number of previous headers whose median time a header must be after
+MEDIAN_TIME_SPAN = 11
+
+# seconds a header time may be ahead of the local clock
+MAX_FUTURE_BLOCK_TIME = 2 * 60 * 60
+
+# height -> block hash (raw little endian) the main chain must have
+# time and difficulty of headers at or below the highest checkpoint are not checked
+CHECKPOINTS = {}
 
 
 # header of each block in blockchain
+# a lightweight view of one row of the header store
 class Header:
 
-	def __init__(self, ver_num, prev_hash, merk_hash, start_time, nBits, nonce):
-		# block version number indicates which set of block validation rules to follow
-		# 4 bytes little endian
-		self.version = ver_num
-		# SHA256(SHA256()) hash in internal byte order of the previous block's header
-		# 32 bytes little endian
-		self.previous_block_header_hash = prev_hash
-		# SHA256(SHA256()) hash in internal byte order
-		# merkle root is derived from hashes of all transactions included in this block,
-		# ensuring none of the transactions can be modified without modifying the header
-		# 32 bytes little endian
-		self.merkle_root_hash = merk_hash
-		# block time is a Unix epoch time when the miner started hashing the header
-		# Must be strictly greater than the median time of the previous 11 blocks
-		# 4 bytes little endian
-		self.start_time = start_time
-		# target threshold this block's header hash must be less than or equal to
-		# 4 bytes little endian
-		self.nBits = nBits
-		# arbitrary number miners change to modify the header hash in order to produce a
-		# hash less than or equal to the target threshold
-		# 4 bytes little endian
-		self.nonce = nonce
-		# indicator of whether this block is in the longest blockchain
-		self.main_chain = False
-		# blockchain height of this block
-		self.height = 0
+	def __init__(self, row):
+		# row of the header store
+		self.row = row
+
+	def get_field(self, start, size):
+		# raw field bytes of this header
+		# version (4) | previous block hash (32) | merkle root (32) | time (4) | nBits (4) | nonce (4)
+		header_start = self.row * 80 + start
+		return bytes(raw_headers[header_start: header_start + size])
 
 	def get_version_int(self):
-		return int(self.version.decode('hex')[::-1].encode('hex_codec'), 16)
+		return struct.unpack("<I", self.get_field(0, 4))[0]
 
 	def get_time_int(self):
-		return int(self.start_time.decode('hex')[::-1].encode('hex_codec'), 16)
+		return struct.unpack("<I", self.get_field(68, 4))[0]
 
 	def get_nBits_int(self):
-		return int(self.nBits.decode('hex')[::-1].encode('hex_codec'), 16)
+		return struct.unpack("<I", self.get_field(72, 4))[0]
 
 	def get_nonce_int(self):
-		return int(self.nonce.decode('hex')[::-1].encode('hex_codec'), 16)
+		return struct.unpack("<I", self.get_field(76, 4))[0]
 
 	def get_merk_hash_little(self):
-		return self.merkle_root_hash
+		return self.get_field(36, 32)
 
 	def get_merk_hash_big(self):
-		# convert to binary
-		hash_bin = self.merkle_root_hash.decode('hex')
-
-		# big-endian hash
-		hash_hex = hash_bin[::-1].encode('hex_codec')
+		# big-endian hex string
+		hash_hex = byte_to_hex_string_big(self.get_merk_hash_little())
 
 		return hash_hex
 
 	def set_main_chain(self):
-		self.main_chain = True
+		main_chain_flags[self.row] = 1
 		return
 
 	def get_main_chain(self):
-		return self.main_chain
+		return main_chain_flags[self.row] == 1
 
 	def set_height(self, height):
-		self.height = height
+		heights[self.row] = height
 		return
 
 	def get_height(self):
-		return self.height
+		return heights[self.row]
+
+	def set_chain_work(self, chain_work):
+		chain_works[self.row * 32: self.row * 32 + 32] = binascii.unhexlify("%064x" % chain_work)
+		return
+
+	def get_chain_work(self):
+		return int(binascii.hexlify(chain_works[self.row * 32: self.row * 32 + 32]), 16)
+
+	def get_work(self):
+		return get_work(self.get_nBits_int())
 
 	def get_prev_hash_little(self):
-		return self.previous_block_header_hash
+		return self.get_field(4, 32)
 
 	def get_prev_hash_big(self):
-		# convert to binary
-		hash_bin = self.previous_block_header_hash.decode('hex')
-
-		# big-endian hash
-		hash_hex = hash_bin[::-1].encode('hex_codec')
+		# big-endian hex string
+		hash_hex = byte_to_hex_string_big(self.get_prev_hash_little())
 
 		return hash_hex
 
 	def get_curr_hash_little(self):
-		# header in little-endian hex
-		header_hex = (self.version + self.previous_block_header_hash + self.merkle_root_hash + 
-			self.start_time + self.nBits + self.nonce)
+		# little-endian hash
+		return bytes(header_hashes[self.row * 32: self.row * 32 + 32])
 
-		# convert to binary
-		header_bin = header_hex.decode('hex')
+	def get_curr_hash_big(self):
+		# big-endian hex string
+		hash_big = byte_to_hex_string_big(self.get_curr_hash_little())
 
-		# SHA256(SHA256(header))
-		header_hash = hashlib.sha256(hashlib.sha256(header_bin).digest()).digest()
+		return hash_big
 
-		# little-endian hash
-		hash_little = header_hash.encode('hex_codec')
 
-		return hash_little
+def get_target(nBits):
+	# nBits is a compact target: 1 byte exponent and 3 bytes mantissa
+	exponent = nBits >> 24
+	mantissa = nBits & 0x007FFFFF
 
-	def get_curr_hash_big(self):
-		# header in little-endian hex
-		header_hex = (self.version + self.previous_block_header_hash + self.merkle_root_hash + 
-			self.start_time + self.nBits + self.nonce)
+	# target = mantissa * 256^(exponent - 3)
+	if exponent <= 3:
+		return mantissa >> (8 * (3 - exponent))
+
+	return mantissa << (8 * (exponent - 3))
 
-		# convert to binary
-		header_bin = header_hex.decode('hex')
 
-		# SHA256(SHA256(header))
-		header_hash = hashlib.sha256(hashlib.sha256(header_bin).digest()).digest()
+def get_compact(target):
+	# smallest compact nBits encoding of a target
+	size = (target.bit_length() + 7) / 8
+	if size <= 3:
+		mantissa = target << (8 * (3 - size))
+	else:
+		mantissa = target >> (8 * (size - 3))
 
-		# big-endian hash
-		hash_big = header_hash[::-1].encode('hex_codec')
+	# mantissa sign bit must stay clear
+	if mantissa & 0x00800000:
+		mantissa >>= 8
+		size += 1
+
+	return (size << 24) | mantissa
+
+
+def get_work(nBits):
+	# expected number of hashes to find a header meeting the nBits target
+	target = get_target(nBits)
+	if target <= 0:
+		return 0
+
+	return (1 << 256) / (target + 1)
+
+
+def search_cache_index(index_start, record_count, key):
+	# binary search a sorted index of the header cache
+	data = header_index_data
+	if data is None:
+		return None
+
+	low = 0
+	high = record_count
+
+	while low < high:
+		mid = (low + high) / 2
+		record_start = index_start + mid * INDEX_RECORD_SIZE
+		mid_key = data[record_start: record_start + 32]
+
+		if mid_key < key:
+			low = mid + 1
+		elif mid_key > key:
+			high = mid
+		else:
+			return struct.unpack_from("<I", data, record_start + 32)[0]
+
+	return None
+
+
+def find_row(curr_hash):
+	# rows added since the header cache was loaded
+	if curr_hash in curr_hash_to_row:
+		return curr_hash_to_row[curr_hash]
+
+	# rows loaded from the header cache, None if unknown
+	return search_cache_index(cached_hash_index_start, cached_row_count, curr_hash)
+
+
+def find_merkle_row(merk_hash):
+	# rows added since the header cache was loaded
+	if merk_hash in merkle_root_to_row:
+		return merkle_root_to_row[merk_hash]
+
+	# rows loaded from the header cache, None if unknown
+	return search_cache_index(cached_merkle_index_start, cached_merkle_count, merk_hash)
 
-		return hash_big
+
+def get_header(curr_hash):
+	# header view of a block header hash, None if unknown
+	row = find_row(curr_hash)
+	if row is None:
+		return None
+
+	return Header(row)
 
 
 def byte_to_hex_string_little(bytes):
@@ -169,171 +336,727 @@ def byte_to_hex_string_big(bytes):
 
 
 def parse_header(raw_data, nth_byte):
-	# version number
-	ver_num = byte_to_hex_string_little(raw_data[nth_byte: nth_byte + 4])
-	#print ver_num
-	nth_byte += 4
-
-	# previous block's header hash
-	prev_hash = byte_to_hex_string_little(raw_data[nth_byte: nth_byte + 32])
-	#print prev_hash
-	nth_byte += 32
-
-	# merkle root hash
-	merk_hash = byte_to_hex_string_little(raw_data[nth_byte: nth_byte + 32])
-	#print merk_hash
-	nth_byte += 32
-
-	# Unix epoch time
-	start_time = byte_to_hex_string_little(raw_data[nth_byte: nth_byte + 4])
-	#print start_time
-	nth_byte += 4
-
-	# target difficulty threshold
-	nBits = byte_to_hex_string_little(raw_data[nth_byte: nth_byte + 4])
-	#print nBits
-	nth_byte += 4
-
-	# arbitrary number to match difficulty
-	nonce = byte_to_hex_string_little(raw_data[nth_byte: nth_byte + 4])
-	#print nonce
-	nth_byte += 4
-
-	# create header
-	header = Header(ver_num, prev_hash, merk_hash, start_time, nBits, nonce)
-
-	# prev -> curr headers
-	if prev_hash in prev_hash_to_block_headers:
-		# another chain of blocks
-		prev_hash_to_block_headers[prev_hash].append(header)
-	else:
-		prev_hash_to_block_headers[prev_hash] = [header]
+	global block_count
+
+	# raw 80 byte header
+	header_bin = raw_data[nth_byte: nth_byte + 80]
 
-	# curr -> prev
-	curr_hash_to_prev_hash[header.get_curr_hash_little()] = prev_hash
+	# SHA256(SHA256(header)), computed once per header
+	curr_hash = hashlib.sha256(hashlib.sha256(header_bin).digest()).digest()
+
+	# skip a header without enough proof of work
+	if not check_proof_of_work(curr_hash, struct.unpack_from("<I", header_bin, 72)[0]):
+		return
+
+	# skip a header already in the store
+	if find_row(curr_hash) is not None:
+		return
 
-	# curr -> header
-	curr_hash_to_block_header[header.get_curr_hash_little()] = header
+	# new row
+	row = block_count
+	block_count += 1
 
-	# merk -> curr
-	merkle_root_to_curr_hash[merk_hash] = header.get_curr_hash_little()
+	raw_headers.extend(header_bin)
+	header_hashes.extend(curr_hash)
+	prev_rows.append(-1)
+	heights.append(-1)
+	chain_works.extend(b"\x00" * 32)
+	main_chain_flags.append(0)
+
+	# curr -> row
+	curr_hash_to_row[curr_hash] = row
+
+	# merk -> row
+	# merkle root hash sits after version number and previous block's header hash
+	# the first header seen with a merkle root keeps it
+	merk_hash = header_bin[36: 68]
+	if find_merkle_row(merk_hash) is None:
+		merkle_root_to_row[merk_hash] = row
 
 	return
 
 
-def load_headers(filename):
-	global block_count
+def check_proof_of_work(curr_hash, nBits):
+	# compact target must be positive and no easier than the proof of work limit
+	target = get_target(nBits)
+	if nBits & 0x00800000 or target <= 0 or target > get_target(POW_LIMIT_NBITS):
+		return False
+
+	# little endian header hash as an integer must not exceed the target
+	return int(binascii.hexlify(curr_hash[::-1]), 16) <= target
+
+
+def get_next_nBits(prev_row, height):
+	# nBits a header at height on top of prev_row must have
+	prev_nBits = struct.unpack_from("<I", raw_headers, prev_row * 80 + 72)[0]
+
+	# difficulty only changes every retarget interval
+	if height % RETARGET_INTERVAL != 0:
+		return prev_nBits
+
+	# first header of the interval ending at prev_row
+	first_row = prev_row
+	for i in xrange(0, RETARGET_INTERVAL - 1):
+		first_row = prev_rows[first_row]
 
-	header_start = 0
+	# time the interval took, limited to a factor of 4 either way
+	timespan = (struct.unpack_from("<I", raw_headers, prev_row * 80 + 68)[0] -
+				struct.unpack_from("<I", raw_headers, first_row * 80 + 68)[0])
+	timespan = max(RETARGET_TIMESPAN / 4, min(timespan, RETARGET_TIMESPAN * 4))
 
+	# scale the target by how far the interval was off
+	target = get_target(prev_nBits) * timespan / RETARGET_TIMESPAN
+	target = min(target, get_target(POW_LIMIT_NBITS))
+
+	return get_compact(target)
+
+
+def check_header(row, prev_row):
+	# check a header against its previous headers before connecting it
+	height = heights[prev_row] + 1 if prev_row != -1 else 0
+
+	# header at a checkpoint height must be the checkpoint
+	checkpoint_hash = CHECKPOINTS.get(height)
+	if checkpoint_hash is not None and checkpoint_hash != bytes(header_hashes[row * 32: row * 32 + 32]):
+		return False
+
+	# history up to the last checkpoint is trusted
+	if len(CHECKPOINTS) > 0 and height <= max(CHECKPOINTS):
+		return True
+
+	if prev_row == -1:
+		return True
+
+	# header time must be after the median time of the previous headers,
+	# so more than half of them must be earlier, usually the nearest ones
+	header_time = struct.unpack_from("<I", raw_headers, row * 80 + 68)[0]
+	span = min(MEDIAN_TIME_SPAN, height)
+	earlier_count = 0
+	time_row = prev_row
+	for i in xrange(0, span):
+		if struct.unpack_from("<I", raw_headers, time_row * 80 + 68)[0] < header_time:
+			earlier_count += 1
+			if earlier_count > span / 2:
+				break
+		time_row = prev_rows[time_row]
+
+	if earlier_count <= span / 2:
+		return False
+
+	# difficulty must follow the retarget rule
+	return struct.unpack_from("<I", raw_headers, row * 80 + 72)[0] == get_next_nBits(prev_row, height)
+
+
+def is_header_too_new(row):
+	# header time must not be too far in the future
+	# only for now, the header is checked again once the local clock has caught up
+	header_time = struct.unpack_from("<I", raw_headers, row * 80 + 68)[0]
+	return header_time > time.time() + MAX_FUTURE_BLOCK_TIME
+
+
+def load_headers(filename, header_start=0):
 	# open file to load block headers
 	with open(filename, "rb") as file:
+		# skip headers already loaded
+		file.seek(header_start)
 		data = file.read()
-		# get the file size
-		file_end = os.stat(filename).st_size
-		
-		# parse every block header
-		while True:
-			parse_header(data, header_start)
 
-			# track total block parsed
-			block_count += 1
+	# parse every block header
+	nth_byte = 0
+	# ver_num + prev_hash + merk_hash + time + nits + nonce
+	while (nth_byte + (4 + 32 + 32 + 4 + 4 + 4)) <= len(data):
+		parse_header(data, nth_byte)
 
-			# ver_num + prev_hash + merk_hash + time + nits + nonce
-			header_start += (4 + 32 + 32 + 4 + 4 + 4)
+		nth_byte += (4 + 32 + 32 + 4 + 4 + 4)
 
-			# check if file ends
-			if (header_start + (4 + 32 + 32 + 4 + 4 + 4)) > file_end:
-				break
+	# bytes of the file consumed
+	return header_start + nth_byte
 
-	file.close()
-	return
+
+def connect_header(row, prev_row):
+	# link a header to its previous header and derive its height and chain work
+	header = Header(row)
+	prev_rows[row] = prev_row
+
+	if prev_row == -1:
+		# genesis block
+		header.set_height(0)
+		header.set_chain_work(header.get_work())
+	else:
+		prev_header = Header(prev_row)
+		header.set_height(prev_header.get_height() + 1)
+		header.set_chain_work(prev_header.get_chain_work() + header.get_work())
+
+	mark_changed_row(row)
+
+	return header
 
 
 def compute_distances_bfs():
-	# start from source vertex
-	queue = [source_hash]
-	# mark all vertices not visited
-	distances = {source_hash: 0}
-	# track the longest distance to source
-	max_distance = -1
-	max_hash = ""
+	# child lists of every row kept as linked lists in arrays
+	first_child = array.array("i", [-1]) * block_count
+	next_sibling = array.array("i", [-1]) * block_count
+
+	# start from source vertex, the genesis blocks
+	queue = collections.deque()
+
+	for row in range(0, block_count):
+		prev_hash = bytes(raw_headers[row * 80 + 4: row * 80 + 36])
+
+		if prev_hash == source_hash:
+			queue.append((row, -1))
+		else:
+			prev_row = find_row(prev_hash)
+			if prev_row is None:
+				continue
+
+			# prepend to child list of the previous header
+			next_sibling[row] = first_child[prev_row]
+			first_child[prev_row] = row
+
+	# track the chain with the most cumulative work
+	max_work = -1
+	max_row = -1
 
 	# traverse all vertices
 	while len(queue) != 0:
-		# remove and return first element in list
-		curr_hash = queue.pop(0)
+		# remove and return first element in deque
+		row, prev_row = queue.popleft()
+
+		# an invalid header and every header on top of it stay unconnected
+		if not check_header(row, prev_row):
+			continue
 
-		# skip vertex with no outgoing neighbor
-		if curr_hash not in prev_hash_to_block_headers:
+		# a header from the future waits in pending_rows with every header on top of it
+		if is_header_too_new(row):
 			continue
 
-		# get all outgoing neighbors
-		headers = prev_hash_to_block_headers[curr_hash]
+		# compute height and cumulative work from the parent
+		chain_work = connect_header(row, prev_row).get_chain_work()
+
+		# record chain with most work, the first one seen wins a tie
+		if chain_work > max_work:
+			max_work = chain_work
+			max_row = row
+
+		# insert outgoing neighbors to end of deque
+		child_row = first_child[row]
+		while child_row != -1:
+			queue.append((child_row, row))
+			child_row = next_sibling[child_row]
+
+	# headers whose previous header is missing connect once it arrives
+	add_orphan_rows(0)
+
+	# no header connects to the genesis block
+	if max_row == -1:
+		return b"", -1
+
+	return Header(max_row).get_curr_hash_little(), heights[max_row]
 
-		# traverse outgoing neighbors
-		for header in headers:
-			# compute header hash
-			next_hash = header.get_curr_hash_little()
 
-			# add to stack if not visited
-			if next_hash not in distances:
-				# insert element to end of list
-				queue.append(next_hash)
+def flag_main_chain(tip_row):
+	# flag main chain blocks from the latest block back to where the old main chain is joined
+	row = tip_row
+	while row != -1 and main_chain_flags[row] == 0:
+		main_chain_flags[row] = 1
+		mark_changed_row(row)
+		row = prev_rows[row]
 
-				# compute distance to source
-				distances[next_hash] = distances[curr_hash] + 1
-				header.set_height(distances[next_hash] - 1)
+	# the fork point, -1 if the whole chain was flagged
+	return row
 
-				# record longest chain
-				if distances[next_hash] > max_distance:
-					max_distance = distances[next_hash]
-					max_hash = next_hash
 
-	return max_hash, max_distance - 1
+def unflag_main_chain(tip_row, fork_row):
+	# clear main chain flags of an orphaned fork down to the fork point
+	row = tip_row
+	while row != fork_row and row != -1:
+		main_chain_flags[row] = 0
+		mark_changed_row(row)
+		row = prev_rows[row]
+
+	return
+
+
+def add_orphan_rows(first_row):
+	# remember every row from first_row on that is not connected
+	# rows on a connected previous header are checked again, the others wait for it by its hash
+	for row in xrange(first_row, block_count):
+		if heights[row] == -1:
+			prev_hash = bytes(raw_headers[row * 80 + 4: row * 80 + 36])
+			prev_row = find_row(prev_hash) if prev_hash != source_hash else -1
+
+			if prev_hash == source_hash or (prev_row is not None and heights[prev_row] != -1):
+				pending_rows.add(row)
+			else:
+				orphan_rows.setdefault(prev_hash, []).append(row)
+
+	return
+
+
+def extend_chain(first_row):
+	global blockchain_height
+	global latest_block_little
+
+	# current tip
+	tip_row = find_row(latest_block_little) if latest_block_little != b"" else None
+	tip_work = Header(tip_row).get_chain_work() if tip_row is not None else -1
+	best_row = tip_row
+
+	# new rows whose previous header is connected, and the rows they connect, breadth first
+	queue = collections.deque()
+
+	# headers that were too new last time, and invalid ones left unconnected by an earlier run
+	for row in sorted(pending_rows):
+		prev_hash = bytes(raw_headers[row * 80 + 4: row * 80 + 36])
+		prev_row = find_row(prev_hash) if prev_hash != source_hash else -1
+		if prev_row is not None:
+			queue.append((row, prev_row))
+	pending_rows.clear()
+
+	for row in range(first_row, block_count):
+		prev_hash = bytes(raw_headers[row * 80 + 4: row * 80 + 36])
+
+		if prev_hash == source_hash:
+			queue.append((row, -1))
+		else:
+			prev_row = find_row(prev_hash)
+
+			# previous header is unknown or not connected yet, wait for it
+			if prev_row is None or heights[prev_row] == -1:
+				orphan_rows.setdefault(prev_hash, []).append(row)
+			else:
+				queue.append((row, prev_row))
+
+	while len(queue) != 0:
+		row, prev_row = queue.popleft()
+
+		# an invalid header and every header on top of it stay unconnected
+		if not check_header(row, prev_row):
+			continue
+
+		# a header from the future is checked again with the next headers
+		if is_header_too_new(row):
+			pending_rows.add(row)
+			continue
+
+		chain_work = connect_header(row, prev_row).get_chain_work()
+
+		# record chain with most work, the current tip wins a tie
+		if chain_work > tip_work:
+			tip_work = chain_work
+			best_row = row
+
+		# rows that arrived before this one and build on it
+		for child_row in orphan_rows.pop(bytes(header_hashes[row * 32: row * 32 + 32]), []):
+			queue.append((child_row, row))
+
+	# tip did not change
+	if best_row is None or best_row == tip_row:
+		return
+
+	# re-flag only the blocks between the fork point and the two tips
+	fork_row = flag_main_chain(best_row)
+	if tip_row is not None and tip_row != fork_row:
+		unflag_main_chain(tip_row, fork_row)
+
+		# transactions of the orphaned fork are no longer verified
+		invalidate_verified_tx_cache()
+
+	blockchain_height = heights[best_row]
+	latest_block_little = Header(best_row).get_curr_hash_little()
+
+	return
+
+
+def mark_changed_row(row):
+	# a row already in the header cache log is written again by the next save
+	if row < saved_row_count:
+		changed_rows.add(row)
+
+	return
+
+
+def get_sorted_index_records(index_start, record_count, new_rows):
+	# stream records of a sorted index, merging the cached records with new ones
+	cached_records = []
+	if header_index_data is not None:
+		cached_records = (header_index_data[index_start + i * INDEX_RECORD_SIZE:
+											index_start + (i + 1) * INDEX_RECORD_SIZE]
+						for i in xrange(0, record_count))
+
+	new_records = sorted([key + struct.pack("<I", new_rows[key]) for key in new_rows])
+
+	return heapq.merge(cached_records, new_records)
+
+
+def write_segment(cache_file, first_row, rows):
+	# columns of rows from first_row on, then the changed rows before it
+	cache_file.write(struct.pack(SEGMENT_INFO, first_row, block_count - first_row, len(rows)))
+
+	cache_file.write(raw_headers[first_row * 80:])
+	cache_file.write(header_hashes[first_row * 32:])
+	cache_file.write(prev_rows[first_row:].tostring())
+	cache_file.write(heights[first_row:].tostring())
+	cache_file.write(chain_works[first_row * 32:])
+	cache_file.write(main_chain_flags[first_row:])
+
+	for row in sorted(rows):
+		cache_file.write(struct.pack(CHANGED_ROW_FORMAT, row, prev_rows[row], heights[row],
+									bytes(chain_works[row * 32: row * 32 + 32]), main_chain_flags[row]))
+
+	return
+
+
+def save_header_cache(headers_end, last_header_hash):
+	global saved_row_count
+	global saved_log_end
+	global saved_segment_count
+
+	# append rows added and changed since the last save to the header cache log
+	tip_row = find_row(latest_block_little) if latest_block_little != b"" else None
+	if tip_row is None:
+		tip_row = -1
+
+	if saved_log_end == 0 or saved_segment_count >= HEADER_CACHE_MAX_SEGMENTS:
+		# write every row as one segment
+		with open(HEADER_CACHE_FILENAME + ".tmp", "wb") as cache_file:
+			cache_file.write(struct.pack(HEADER_CACHE_INFO, HEADER_CACHE_MAGIC, HEADER_CACHE_VERSION,
+										block_count, tip_row, headers_end, last_header_hash, 0, 0))
+			write_segment(cache_file, 0, [])
+			log_end = cache_file.tell()
+
+			cache_file.seek(0)
+			cache_file.write(struct.pack(HEADER_CACHE_INFO, HEADER_CACHE_MAGIC, HEADER_CACHE_VERSION,
+										block_count, tip_row, headers_end, last_header_hash, log_end, 1))
+
+		os.rename(HEADER_CACHE_FILENAME + ".tmp", HEADER_CACHE_FILENAME)
+		segment_count = 1
+		rewritten = True
+
+	else:
+		rewritten = False
+		with open(HEADER_CACHE_FILENAME, "r+b") as cache_file:
+			log_end = saved_log_end
+			segment_count = saved_segment_count
+
+			# nothing but the headers file position changed
+			if block_count > saved_row_count or len(changed_rows) > 0:
+				# drop whatever a save cut short wrote past the log
+				cache_file.seek(saved_log_end)
+				cache_file.truncate()
+				write_segment(cache_file, saved_row_count, changed_rows)
+				log_end = cache_file.tell()
+				segment_count += 1
+
+			# info last, a save cut short leaves the log of the previous one
+			cache_file.flush()
+			cache_file.seek(0)
+			cache_file.write(struct.pack(HEADER_CACHE_INFO, HEADER_CACHE_MAGIC, HEADER_CACHE_VERSION,
+										block_count, tip_row, headers_end, last_header_hash,
+										log_end, segment_count))
+
+	saved_row_count = block_count
+	saved_log_end = log_end
+	saved_segment_count = segment_count
+	changed_rows.clear()
+
+	# merge new rows into the sorted indexes once enough have been added, or with a rewritten log
+	if len(curr_hash_to_row) >= HEADER_INDEX_MERGE_SIZE or rewritten or header_index_data is None:
+		merge_header_index()
+
+	return
+
+
+def merge_header_index():
+	# write the sorted indexes with the rows added since the last merge
+	with open(HEADER_INDEX_FILENAME + ".tmp", "wb") as index_file:
+		last_hash = bytes(header_hashes[block_count * 32 - 32: block_count * 32])
+		index_file.write(struct.pack(HEADER_INDEX_INFO, block_count,
+									cached_merkle_count + len(merkle_root_to_row), last_hash))
+
+		for record in get_sorted_index_records(cached_hash_index_start, cached_row_count, curr_hash_to_row):
+			index_file.write(record)
+		for record in get_sorted_index_records(cached_merkle_index_start, cached_merkle_count, merkle_root_to_row):
+			index_file.write(record)
+
+	os.rename(HEADER_INDEX_FILENAME + ".tmp", HEADER_INDEX_FILENAME)
+
+	# serve lookups from the new indexes
+	close_header_index()
+	open_header_index()
+	curr_hash_to_row.clear()
+	merkle_root_to_row.clear()
+
+	return
+
+
+def open_header_index():
+	global header_index_data
+	global cached_row_count
+	global cached_merkle_count
+	global cached_hash_index_start
+	global cached_merkle_index_start
+
+	# no usable index, rows are looked up in memory
+	if not os.path.isfile(HEADER_INDEX_FILENAME):
+		return
+	if os.stat(HEADER_INDEX_FILENAME).st_size < struct.calcsize(HEADER_INDEX_INFO):
+		return
+
+	with open(HEADER_INDEX_FILENAME, "rb") as index_file:
+		data = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+	row_count, merkle_count, last_hash = struct.unpack_from(HEADER_INDEX_INFO, data, 0)
+
+	# index is truncated or was built from another store
+	if (len(data) != struct.calcsize(HEADER_INDEX_INFO) + (row_count + merkle_count) * INDEX_RECORD_SIZE or
+			row_count > block_count or
+			bytes(header_hashes[row_count * 32 - 32: row_count * 32]) != (last_hash if row_count > 0 else b"")):
+		data.close()
+		return
+
+	header_index_data = data
+	cached_row_count = row_count
+	cached_merkle_count = merkle_count
+
+	# hash index is followed by the merkle root index
+	cached_hash_index_start = struct.calcsize(HEADER_INDEX_INFO)
+	cached_merkle_index_start = cached_hash_index_start + cached_row_count * INDEX_RECORD_SIZE
+
+	return
+
+
+def close_header_index():
+	global header_index_data
+	global cached_row_count
+	global cached_merkle_count
+
+	if header_index_data is not None:
+		header_index_data.close()
+
+	header_index_data = None
+	cached_row_count = 0
+	cached_merkle_count = 0
+	return
+
+
+def read_header_cache(data, row_count, log_end, segment_count):
+	global block_count
+
+	# replay the segments of the header cache log into the store
+	# False if the log is cut short or its segments do not follow each other
+	nth_byte = struct.calcsize(HEADER_CACHE_INFO)
+
+	for i in xrange(0, segment_count):
+		if nth_byte + struct.calcsize(SEGMENT_INFO) > log_end:
+			return False
+		first_row, new_count, changed_count = struct.unpack_from(SEGMENT_INFO, data, nth_byte)
+		nth_byte += struct.calcsize(SEGMENT_INFO)
+
+		segment_size = new_count * sum(COLUMN_SIZES) + changed_count * struct.calcsize(CHANGED_ROW_FORMAT)
+		if first_row != block_count or nth_byte + segment_size > log_end:
+			return False
+
+		# copy columns of new rows into the store in bulk, no header is parsed or hashed again
+		for column, size in zip([raw_headers, header_hashes, prev_rows, heights, chain_works, main_chain_flags],
+								COLUMN_SIZES):
+			column_bytes = data[nth_byte: nth_byte + new_count * size]
+			if isinstance(column, array.array):
+				column.fromstring(column_bytes)
+			else:
+				column.extend(column_bytes)
+			nth_byte += new_count * size
+
+		block_count += new_count
+
+		# rows saved before and changed since
+		for j in xrange(0, changed_count):
+			row, prev_row, height, chain_work, main_chain_flag = struct.unpack_from(CHANGED_ROW_FORMAT, data, nth_byte)
+			nth_byte += struct.calcsize(CHANGED_ROW_FORMAT)
+			if row >= block_count:
+				return False
+
+			prev_rows[row] = prev_row
+			heights[row] = height
+			chain_works[row * 32: row * 32 + 32] = chain_work
+			main_chain_flags[row] = main_chain_flag
+
+	return block_count == row_count
+
+
+def load_header_cache(filename):
+	global blockchain_height
+	global latest_block_little
+	global saved_row_count
+	global saved_log_end
+	global saved_segment_count
+
+	# no usable cache
+	if not os.path.isfile(HEADER_CACHE_FILENAME):
+		return None
+	if os.stat(HEADER_CACHE_FILENAME).st_size < struct.calcsize(HEADER_CACHE_INFO):
+		return None
+
+	with open(HEADER_CACHE_FILENAME, "rb") as cache_file:
+		data = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+	try:
+		(magic, version, row_count, tip_row, headers_end, last_header_hash,
+			log_end, segment_count) = struct.unpack_from(HEADER_CACHE_INFO, data, 0)
+
+		# cache written by another version
+		if magic != HEADER_CACHE_MAGIC or version != HEADER_CACHE_VERSION:
+			return None
+
+		# cache is truncated
+		if len(data) < log_end:
+			return None
+
+		# headers file must still start with the headers the cache was built from
+		if os.stat(filename).st_size < headers_end:
+			return None
+		if headers_end > 0:
+			with open(filename, "rb") as file:
+				file.seek(headers_end - 80)
+				header_bin = file.read(80)
+			if hashlib.sha256(hashlib.sha256(header_bin).digest()).digest() != last_header_hash:
+				return None
+
+		if not read_header_cache(data, row_count, log_end, segment_count):
+			reset()
+			return None
+	finally:
+		data.close()
+
+	saved_row_count = row_count
+	saved_log_end = log_end
+	saved_segment_count = segment_count
+
+	# rows past the sorted indexes are looked up in memory until the next merge
+	open_header_index()
+	for row in xrange(cached_row_count, block_count):
+		curr_hash_to_row[bytes(header_hashes[row * 32: row * 32 + 32])] = row
+
+		# the first header seen with a merkle root keeps it
+		merk_hash = bytes(raw_headers[row * 80 + 36: row * 80 + 68])
+		if find_merkle_row(merk_hash) is None:
+			merkle_root_to_row[merk_hash] = row
+
+	# headers whose previous header is missing connect once it arrives
+	add_orphan_rows(0)
+
+	if tip_row != -1:
+		blockchain_height = heights[tip_row]
+		latest_block_little = Header(tip_row).get_curr_hash_little()
+
+	return headers_end
+
+
+def get_last_header_hash(filename, headers_end):
+	# hash of the last consumed header lets the next run check the headers file
+	if headers_end == 0:
+		return source_hash
+
+	with open(filename, "rb") as file:
+		file.seek(headers_end - 80)
+		header_bin = file.read(80)
+
+	return hashlib.sha256(hashlib.sha256(header_bin).digest()).digest()
+
+
+def load_new_headers(filename):
+	global headers_consumed
+
+	# parse headers appended to the headers file and link them into the chain index
+	# a reorg only re-flags the blocks of the forks
+	first_new_row = block_count
+	headers_consumed = load_headers(filename, headers_consumed)
+	extend_chain(first_new_row)
+
+	# number of new headers
+	return block_count - first_new_row
+
+
+def reset():
+	global block_count
+	global blockchain_height
+	global latest_block_little
+	global headers_consumed
+
+	global saved_row_count
+	global saved_log_end
+	global saved_segment_count
+
+	# drop every header, used when the headers file is replaced
+	close_header_index()
+	del raw_headers[:]
+	del header_hashes[:]
+	del prev_rows[:]
+	del heights[:]
+	del chain_works[:]
+	del main_chain_flags[:]
+	curr_hash_to_row.clear()
+	merkle_root_to_row.clear()
+	orphan_rows.clear()
+	pending_rows.clear()
+	verified_tx_cache.clear()
+	changed_rows.clear()
+
+	block_count = 0
+	blockchain_height = 0
+	latest_block_little = b""
+	headers_consumed = 0
+	saved_row_count = 0
+	saved_log_end = 0
+	saved_segment_count = 0
+
+	return
 
 
 def setup(filename):
 	global blockchain_height
 	global latest_block_little
+	global headers_consumed
+
+	# warm start from the header cache, only headers past it are parsed
+	print("Load block header cache...")
+	headers_start = load_header_cache(filename)
 
-	# load all block headers
-	print("Load block headers file...")
-	load_headers(filename)
+	if headers_start is not None:
+		first_new_row = block_count
 
-	# breath first search to compute each vertex distance to source
-	print("Compute BFS distances from genesis block...")
-	longest_hash, longest_chain_height = compute_distances_bfs()
-	#print("Main Chain Height: " + str(longest_chain_height))
-	blockchain_height = longest_chain_height
-	latest_block_little = longest_hash
+		# load block headers appended since the cache was written
+		# and link them into the chain index
+		print("Load new block headers...")
+		headers_consumed = headers_start
+		load_new_headers(filename)
+
+	else:
+		# load all block headers
+		print("Load block headers file...")
+		first_new_row = 0
+		headers_consumed = load_headers(filename)
+
+		# breath first search to compute each vertex height and chain work from source
+		print("Compute BFS distances from genesis block...")
+		longest_hash, longest_chain_height = compute_distances_bfs()
+		#print("Main Chain Height: " + str(longest_chain_height))
+		blockchain_height = longest_chain_height
+		latest_block_little = longest_hash
+
+		# flag main chain blocks from the most-work latest block to genesis block
+		if longest_hash != b"":
+			flag_main_chain(find_row(longest_hash))
 
 	# get latest block hash
-	latest_block = latest_block_little.decode('hex')[::-1].encode('hex_codec')
+	latest_block = byte_to_hex_string_big(latest_block_little)
 	#print("Latest Block Hash: " + latest_block)
-	
-	curr_hash = longest_hash
-	prev_hash = curr_hash_to_prev_hash[longest_hash]
-	# flag main chain blocks from the longest latest block to genesis block
-	while prev_hash != source_hash:
-		# get current block header
-		headers = prev_hash_to_block_headers[prev_hash]
-		for header in headers:
-			# set main chain flag
-			if header.get_curr_hash_little() == curr_hash:
-				#print(curr_hash)
-				header.set_main_chain()
-				break
-		
-		# flag previous block
-		curr_hash = prev_hash
-		prev_hash = curr_hash_to_prev_hash[prev_hash]
-
-	# get genesis block header
-	headers = prev_hash_to_block_headers[source_hash]
-	# set main chain flag
-	headers[0].set_main_chain()
-	
+
+	# persist the chain index if anything changed
+	if block_count > first_new_row or headers_start is None:
+		save_header_cache(headers_consumed, get_last_header_hash(filename, headers_consumed))
+
 	print("All block headers are parsed.")
 	return
 
@@ -371,14 +1094,11 @@ def reconstruct_merkle_tree(tx_count, tx_leaf_index):
 	return hashing_order
 
 
-def verify_transaction(txid, tx_count, tx_leaf_index, tx_branch_hashes, tx_root_hash):
-	# txid (big endian order) of a transaction is requested by user
+def verify_transaction(tx_hash, tx_count, tx_leaf_index, tx_branch_hashes, tx_root_hash):
+	# tx_hash (raw little endian order) of a transaction is requested by user
 	# previously sent to full node proxy to get merkle branches
 
-	# tx_branch_hashes & tx_root_hash (little endian order) are internal between full node proxy and spv client
-
-	# tx_hash is the little endian order transaction hash
-	tx_hash = txid.decode('hex')[::-1].encode('hex_codec')
+	# tx_branch_hashes & tx_root_hash (raw little endian order) are internal between full node proxy and spv client
 
 	# check full node response
 	#assert(tx_count >= 0)
@@ -400,18 +1120,22 @@ def verify_transaction(txid, tx_count, tx_leaf_index, tx_branch_hashes, tx_root_
 
 	# check if the merkle root exists
 	# tx_root_hash is the merkle root given by full node proxy
-	if tx_root_hash not in merkle_root_to_curr_hash:
+	row = find_merkle_row(tx_root_hash)
+	if row is None:
 		return "SPV client should be synchronized to retrieve latest block headers", -1
 
-	# get block hash 
-	curr_hash = merkle_root_to_curr_hash[tx_root_hash]
 	# get block header
-	header = curr_hash_to_block_header[curr_hash]
-	
+	header = Header(row)
+
 	# check if the block belongs to main chain
 	if header.get_main_chain() == False:
 		return "Transaction is not in main chain", -1
 
+	# transaction was already verified in this block
+	if verified_tx_cache.get(tx_hash) == row:
+		cache_verified_transaction(tx_hash, row)
+		return get_confirmations(header)
+
 	# check if the transaction belongs to this block
 	# reconstruct merkle tree to recompute merkle root to verify tx_hash
 	# tx_leaf_index is the index of this transaction in this block
@@ -428,25 +1152,62 @@ def verify_transaction(txid, tx_count, tx_leaf_index, tx_branch_hashes, tx_root_
 		#print(merk_hash)
 		#print(branch_hash)
 
-		# convert to binary data
-		merk_hash_bin = merk_hash.decode('hex')
-		branch_hash_bin = branch_hash.decode('hex')
-		hash_bin = ""
-
 		if left:
 			# SHA256(SHA256(hash | hash))
-			hash_bin = hashlib.sha256(hashlib.sha256(merk_hash_bin + branch_hash_bin).digest()).digest()
+			merk_hash = hashlib.sha256(hashlib.sha256(merk_hash + branch_hash).digest()).digest()
 		else:
 			# SHA256(SHA256(hash | hash))
-			hash_bin = hashlib.sha256(hashlib.sha256(branch_hash_bin + merk_hash_bin).digest()).digest()
-
-		# little-endian hash
-		merk_hash = hash_bin.encode('hex_codec')
+			merk_hash = hashlib.sha256(hashlib.sha256(branch_hash + merk_hash).digest()).digest()
 
 	# verify the recomputed merkle root is the same one in this block header
 	if merk_hash != header.get_merk_hash_little():
 		return "Transaction cannot be verified", -1
 
+	cache_verified_transaction(tx_hash, row)
+
+	return get_confirmations(header)
+
+
+def cache_verified_transaction(tx_hash, row):
+	# most recently verified transaction goes last
+	verified_tx_cache.pop(tx_hash, None)
+	verified_tx_cache[tx_hash] = row
+
+	# evict least recently used transaction
+	if len(verified_tx_cache) > VERIFIED_TX_CACHE_SIZE:
+		verified_tx_cache.popitem(last=False)
+
+	return
+
+
+def get_cached_confirmations(tx_hash):
+	# message and confirmations of an already verified transaction from the current tip,
+	# or None if it has to be verified again
+	row = verified_tx_cache.get(tx_hash)
+	if row is None:
+		return None
+
+	# block was orphaned by a reorg
+	header = Header(row)
+	if header.get_main_chain() == False:
+		del verified_tx_cache[tx_hash]
+		return None
+
+	cache_verified_transaction(tx_hash, row)
+
+	return get_confirmations(header)
+
+
+def invalidate_verified_tx_cache():
+	# drop transactions of blocks no longer in the main chain
+	orphaned_tx_hashes = [tx_hash for tx_hash, row in verified_tx_cache.iteritems() if main_chain_flags[row] == 0]
+	for tx_hash in orphaned_tx_hashes:
+		del verified_tx_cache[tx_hash]
+
+	return
+
+
+def get_confirmations(header):
 	# depth of a block is the number of blocks after it, also called confirmations
 	block_depth = blockchain_height - header.get_height()
 
@@ -460,4 +1221,176 @@ def verify_transaction(txid, tx_count, tx_leaf_index, tx_branch_hashes, tx_root_
 		return "Transaction is close to irreversible", block_depth
 
 
+def parse_var_len_int(data, nth_byte):
+	# variable length integer: 1, 3, 5, or 9 bytes
+	first_byte = struct.unpack_from("<B", data, nth_byte)[0]
+	if first_byte < 0xFD:
+		return first_byte, 1
+	elif first_byte == 0xFD:
+		return struct.unpack_from("<H", data, nth_byte + 1)[0], 3
+	elif first_byte == 0xFE:
+		return struct.unpack_from("<I", data, nth_byte + 1)[0], 5
+	else:
+		return struct.unpack_from("<Q", data, nth_byte + 1)[0], 9
+
+
+def get_merkle_level_width(tx_count, height):
+	# number of hashes in a merkle tree level, without padding
+	return (tx_count + (1 << height) - 1) >> height
+
+
+def traverse_partial_merkle_tree(tx_count, height, pos, partial_hashes, flag_bytes, cursor, matches):
+	# recompute the hash of a node of a BIP37 partial merkle tree
+	# cursor holds the next flag bit and the next hash, matched leaves are added to matches
+	nth_bit = cursor[0]
+	parent_of_match = (ord(flag_bytes[nth_bit / 8]) >> (nth_bit % 8)) & 1
+	cursor[0] += 1
+
+	if height == 0 or not parent_of_match:
+		# node hash stands in for the whole subtree
+		node_hash = partial_hashes[cursor[1]]
+		cursor[1] += 1
+
+		if height == 0 and parent_of_match:
+			matches[node_hash] = pos
+
+		return node_hash
+
+	# recompute from left child and right child, a missing right child repeats the left one
+	left = traverse_partial_merkle_tree(tx_count, height - 1, pos * 2,
+										partial_hashes, flag_bytes, cursor, matches)
+	right = left
+	if pos * 2 + 1 < get_merkle_level_width(tx_count, height - 1):
+		right = traverse_partial_merkle_tree(tx_count, height - 1, pos * 2 + 1,
+											partial_hashes, flag_bytes, cursor, matches)
+
+		# two equal children would let a fake tree hash to the same root
+		if right == left:
+			raise ValueError("duplicate merkle node")
+
+	# SHA256(SHA256(hash | hash))
+	return hashlib.sha256(hashlib.sha256(left + right).digest()).digest()
+
+
+def extract_partial_merkle_tree(tx_count, partial_hashes, flag_bytes):
+	# recompute merkle root and matched transactions of a BIP37 partial merkle tree
+	# https://bitcoin.org/en/developer-reference#parsing-a-merkleblock-message
+	# returns None if the tree is malformed
+	if tx_count == 0 or len(partial_hashes) == 0 or len(partial_hashes) > tx_count:
+		return None
+
+	# height of the merkle root
+	height = 0
+	while get_merkle_level_width(tx_count, height) > 1:
+		height += 1
+
+	# matched transaction hash -> leaf index
+	matches = {}
+	cursor = [0, 0]
+	try:
+		merk_hash = traverse_partial_merkle_tree(tx_count, height, 0, partial_hashes, flag_bytes,
+												cursor, matches)
+	except (IndexError, ValueError):
+		return None
+
+	# every hash and every flag byte must be used
+	if cursor[1] != len(partial_hashes) or (cursor[0] + 7) / 8 != len(flag_bytes):
+		return None
+
+	return merk_hash, matches
+
+
+def parse_merkle_proofs(proofs_data):
+	# parse the binary response of POST /txids
+	# returns a list of (merkle root, total transactions, hashes, flag bytes) and the missing txids,
+	# or None if the response is malformed
+	proofs = []
+
+	try:
+		nth_byte = 0
+		proof_count = struct.unpack_from("<I", proofs_data, nth_byte)[0]
+		nth_byte += 4
+
+		for i in xrange(0, proof_count):
+			# merkle root | total transactions | hashes | flag bytes
+			tx_root_hash = proofs_data[nth_byte: nth_byte + 32]
+			tx_count = struct.unpack_from("<I", proofs_data, nth_byte + 32)[0]
+			nth_byte += 36
+
+			hash_count, num_byte_parsed = parse_var_len_int(proofs_data, nth_byte)
+			nth_byte += num_byte_parsed
+			partial_hashes = [proofs_data[nth_byte + j * 32: nth_byte + (j + 1) * 32] for j in xrange(0, hash_count)]
+			nth_byte += hash_count * 32
+
+			flag_byte_count, num_byte_parsed = parse_var_len_int(proofs_data, nth_byte)
+			nth_byte += num_byte_parsed
+			flag_bytes = proofs_data[nth_byte: nth_byte + flag_byte_count]
+			nth_byte += flag_byte_count
+
+			proofs += [(tx_root_hash, tx_count, partial_hashes, flag_bytes)]
+
+		# missing txid count | missing txids
+		missing_count = struct.unpack_from("<I", proofs_data, nth_byte)[0]
+		nth_byte += 4
+		missing_tx_hashes = [proofs_data[nth_byte + i * 32: nth_byte + (i + 1) * 32] for i in xrange(0, missing_count)]
+		nth_byte += missing_count * 32
+
+	except struct.error:
+		return None
+
+	# response must be used exactly
+	if nth_byte != len(proofs_data):
+		return None
+
+	return proofs, missing_tx_hashes
+
+
+def verify_transactions(tx_hashes, proofs_data):
+	# verify a batch of transactions against the binary proofs of POST /txids
+	# tx_hashes (raw little endian order) are the transactions sent to full node proxy
+	# proofs_data holds one BIP37 partial merkle tree per block, so every block header
+	# is looked up once and merkle nodes shared by transactions are hashed once
+	# returns (message, confirmations) of every transaction in tx_hashes order
+	merkle_proofs = parse_merkle_proofs(proofs_data)
+	if merkle_proofs is None:
+		return [("Full node proxy response is malformed", -1)] * len(tx_hashes)
+	proofs, missing_tx_hashes = merkle_proofs
+
+	# transaction hash -> (message, confirmations)
+	tx_hash_to_result = {}
+
+	for tx_root_hash, tx_count, partial_hashes, flag_bytes in proofs:
+		# recompute merkle root from the partial merkle tree
+		partial_merkle_tree = extract_partial_merkle_tree(tx_count, partial_hashes, flag_bytes)
+		if partial_merkle_tree is None:
+			continue
+		merk_hash, matches = partial_merkle_tree
+
+		# check if the merkle root exists
+		row = find_merkle_row(tx_root_hash)
+		if row is None:
+			result = "SPV client should be synchronized to retrieve latest block headers", -1
+		else:
+			header = Header(row)
+
+			if header.get_main_chain() == False:
+				# check if the block belongs to main chain
+				result = "Transaction is not in main chain", -1
+			elif merk_hash != header.get_merk_hash_little():
+				# verify the recomputed merkle root is the same one in this block header
+				result = "Transaction cannot be verified", -1
+			else:
+				result = get_confirmations(header)
+
+				for tx_hash in matches:
+					cache_verified_transaction(tx_hash, row)
+
+		for tx_hash in matches:
+			tx_hash_to_result[tx_hash] = result
+
+	# transactions full node proxy could not find
+	for tx_hash in missing_tx_hashes:
+		tx_hash_to_result[tx_hash] = "Full node proxy could not find transaction", -1
 
+	# transactions without a valid proof cannot be verified
+	return [tx_hash_to_result.get(tx_hash, ("Transaction cannot be verified", -1)) for tx_hash in tx_hashes]
@@ -0,0 +1,49 @@
+# block_index.py
+# Persistent on-disk index of block header hashes to block locations in .dat files
+#
+# HingOn Miu
+
+# The index is a record file (see record_file.py) of fixed-width records sorted by block hash:
+#   block_hash (32 bytes little endian) | nth_file (4 bytes little endian) |
+#   block_start (8 bytes little endian) | block_size (4 bytes little endian)
+# block_start is the byte offset of the block header in the .dat file, past the magic number
+# and block size. Blocks are read back from the .dat files when they are needed, so only
+# the index is kept.
+
+import struct
+import record_file
+
+
+# bytes of each record
+RECORD_SIZE = 32 + 4 + 8 + 4
+
+# on-disk records, keyed by block hash
+index = record_file.RecordFile(RECORD_SIZE, 32)
+
+
+def pack_record(block_hash, nth_file, block_start, block_size):
+	# block_hash | nth_file | block_start | block_size
+	return block_hash + struct.pack("<IQI", nth_file, block_start, block_size)
+
+
+def unpack_record(record):
+	# nth_file, block_start, block_size
+	return struct.unpack("<IQI", record[32:48])
+
+
+def pack_records(block_hash_to_location):
+	# sorted records of an in-memory index
+	for block_hash in sorted(block_hash_to_location):
+		nth_file, block_start, block_size = block_hash_to_location[block_hash]
+		yield pack_record(block_hash, nth_file, block_start, block_size)
+
+	return
+
+
+def lookup(block_hash):
+	# (nth_file, block_start, block_size) of a block, None if it is not in the index
+	record = index.lookup(block_hash)
+	if record is None:
+		return None
+
+	return unpack_record(record)
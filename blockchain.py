@@ -17,18 +17,90 @@ import time
 import struct
 import binascii
 import hashlib
-
+import mmap
+import multiprocessing
+import threading
+import collections
+import bisect
+import tx_index
+import block_filter
+import script_index
+import block_index
+
+
+# magic number at the start of every block record in .dat files
+MAGIC_NUM = 0xD9B4BEF9
+
+# magic number as it is stored in .dat files, to resync on after bytes that are not a block record
+MAGIC_BYTES = struct.pack("<I", MAGIC_NUM)
+
+# fewest bytes a transaction, an input and an output take, to reject counts a block cannot hold
+# version + input count + output count + lock time
+MIN_TX_SIZE = 4 + 1 + 1 + 4
+# outpoint + script size + sequence number
+MIN_INPUT_SIZE = 32 + 4 + 1 + 4
+# amount + script size
+MIN_OUTPUT_SIZE = 8 + 1
 
 # total number of blocks
 block_count = 0
 
+# on-disk transaction index built from all parsed blocks
+TX_INDEX_FILENAME = "txindex.dat"
+
+# number of in-memory transactions to collect before writing a sorted run to disk
+TX_INDEX_FLUSH_SIZE = 1000000
+
+# raw 80 byte block headers of every parsed block, in the order they were parsed
+BLOCK_HEADERS_FILENAME = "blockheaders.dat"
+
+# on-disk index of block locations in .dat files
+BLOCK_INDEX_FILENAME = "blockindex.dat"
+
+# on-disk index of output scripts and spent outpoints to transactions
+SCRIPT_INDEX_FILENAME = "scriptindex.dat"
+
+# build the script index while parsing blocks
+# off by default, it writes a record for every output and spent outpoint
+BUILD_SCRIPT_INDEX = False
+
+# build a compact filter of every block for wallet scanning
+# off by default, hashing every output script and spent outpoint slows ingestion down
+BUILD_BLOCK_FILTERS = False
+
+# last .dat file and byte offset parsed, to resume incremental sync from
+CHECKPOINT_FILENAME = "checkpoint.dat"
+
+# .dat file, byte offset, header count and filters file size up to which every index is on disk
+# blocks synced after it only have in-memory index entries, a restart parses them again
+# [nth_file, header_start, header_count, filters_size]
+indexed_checkpoint = None
+
 # transaction hash (little endian) to block header hash (little endian)
+# hashes are kept as raw 32 byte strings, hex is only used at the http boundary
+# only holds transactions not yet written to the on-disk transaction index
 # tx_hash -> block_hash, tx_index
 tx_hash_to_block_hash = {}
 
-# block header hash (little endian) to block
-# block_hash -> block
-block_hash_to_block = {}
+# block header hash (little endian) to block location in .dat files
+# only holds blocks not yet written to the on-disk block index
+# block_hash -> nth_file, block_start, block_size
+block_hash_to_location = {}
+
+# directory of the .dat files blocks are read back from
+blockchain_directory = ""
+
+# script index key to packed records of blocks not yet written to the on-disk script index
+# key -> [record]
+script_key_to_records = {}
+
+# number of recently used blocks whose full merkle tree is kept in memory
+MERKLE_TREE_CACHE_SIZE = 1024
+
+# LRU cache of merkle trees of recently used blocks
+# block_hash -> merkle_tree
+merkle_tree_cache = collections.OrderedDict()
+merkle_tree_cache_lock = threading.Lock()
 
 
 # input transaction of a transaction
@@ -39,7 +111,7 @@ class InputTransaction:
 		# 32 bytes little endian
 		self.prev_tx_hash = prev_tx_hash
 		# script that satisfies the conditions placed in the outpoint's pubkey script
-		# variable length hex string
+		# variable length raw bytes
 		self.script = script
 		# sequence number
 		# 4 bytes little endian
@@ -49,11 +121,8 @@ class InputTransaction:
 		return self.prev_tx_hash
 
 	def get_prev_hash_big(self):
-		# convert to binary
-		hash_bin = self.prev_tx_hash.decode('hex')
-
-		# big-endian hash
-		hash_hex = hash_bin[::-1].encode('hex_codec')
+		# big-endian hex string
+		hash_hex = byte_to_hex_string_big(self.prev_tx_hash)
 
 		return hash_hex
 
@@ -61,10 +130,10 @@ class InputTransaction:
 		return self.script
 
 	def get_script_big(self):
-		return self.script.decode('hex')[::-1].encode('hex_codec')
+		return byte_to_hex_string_big(self.script)
 
 	def get_seq_int(self):
-		return int(self.seq_num.decode('hex')[::-1].encode('hex_codec'), 16)
+		return struct.unpack("<I", self.seq_num)[0]
 
 
 # output transaction of a transaction
@@ -75,17 +144,17 @@ class OutputTransaction:
 		# 8 bytes little endian
 		self.satoshi_amount = satoshi_amount
 		# script that satisfies the conditions placed in the outpoint's pubkey script
-		# variable length hex string
+		# variable length raw bytes
 		self.script = script
 
 	def get_satoshi_int(self):
-		return int(self.satoshi_amount.decode('hex')[::-1].encode('hex_codec'), 16)
+		return struct.unpack("<Q", self.satoshi_amount)[0]
 
 	def get_script_little(self):
 		return self.script
 
 	def get_script_big(self):
-		return self.script.decode('hex')[::-1].encode('hex_codec')
+		return byte_to_hex_string_big(self.script)
 
 
 # Each transaction in a block
@@ -116,16 +185,13 @@ class Transaction:
 		return self.hash
 
 	def get_hash_big(self):
-		# convert to binary
-		hash_bin = self.hash.decode('hex')
-
-		# big-endian hash
-		hash_hex = hash_bin[::-1].encode('hex_codec')
+		# big-endian hex string
+		hash_hex = byte_to_hex_string_big(self.hash)
 
 		return hash_hex
 
 	def get_version_int(self):
-		return int(self.version.decode('hex')[::-1].encode('hex_codec'), 16)
+		return struct.unpack("<I", self.version)[0]
 
 	def get_input_count_int(self):
 		return self.input_tx_count
@@ -140,186 +206,128 @@ class Transaction:
 		return self.output_txs
 
 	def get_locktime_int(self):
-		return int(self.locktime.decode('hex')[::-1].encode('hex_codec'), 16)
-
-
-# Each block in blockchain
-class Block:
-
-	def __init__(self, ver_num, prev_hash, merk_hash, start_time, nBits, nonce, tx_count, txs, merkle_tree):
-		# block version number indicates which set of block validation rules to follow
-		# 4 bytes little endian
-		self.version = ver_num
-		# SHA256(SHA256()) hash in internal byte order of the previous block's header
-		# 32 bytes little endian
-		self.previous_block_header_hash = prev_hash
-		# SHA256(SHA256()) hash in internal byte order
-		# merkle root is derived from hashes of all transactions included in this block,
-		# ensuring none of the transactions can be modified without modifying the header
+		return struct.unpack("<I", self.locktime)[0]
+
+
+# Each block streamed from .dat files, with where it is and what indexes need from it
+class BlockRecord:
+
+	def __init__(self, nth_file, block_start, block_size, header_bin, block_hash,
+				tx_offsets, tx_hashes, filter_items=None, script_index_entries=None):
+		# .dat file the block is in
+		self.nth_file = nth_file
+		# byte offset of the block header in the file, past the magic number and block size
+		self.block_start = block_start
+		# bytes of the header and transactions
+		self.block_size = block_size
+		# raw 80 byte block header
+		self.header_bin = header_bin
+		# SHA256(SHA256(header))
 		# 32 bytes little endian
-		self.merkle_root_hash = merk_hash
-		# block time is a Unix epoch time when the miner started hashing the header
-		# Must be strictly greater than the median time of the previous 11 blocks
-		# 4 bytes little endian
-		self.start_time = start_time
-		# target threshold this block's header hash must be less than or equal to
-		# 4 bytes little endian
-		self.nBits = nBits
-		# arbitrary number miners change to modify the header hash in order to produce a
-		# hash less than or equal to the target threshold
-		# 4 bytes little endian
-		self.nonce = nonce
+		self.block_hash = block_hash
+		# byte offset of each transaction in the file
+		self.tx_offsets = tx_offsets
 		# number of transactions in this block
-		self.tx_count = tx_count
-		# list of transactions (Transaction)
-		self.txs = txs
-		# cached merkle tree
-		self.merkle_tree = merkle_tree
-
-	def get_merkle_tree(self):
-		return self.merkle_tree
-
-	def get_transactions(self):
-		return self.txs
+		self.tx_count = len(tx_offsets)
+		# transaction hashes (merkle leaves) packed into one string
+		# 32 bytes little endian each
+		self.tx_hashes = tx_hashes
+		# output scripts and spent outpoints, if collected
+		self.filter_items = filter_items
+		# (key, tx_index, io_index) of the script index, if collected
+		self.script_index_entries = script_index_entries
+
+	def get_end(self):
+		# byte offset of the next block record in the file
+		return self.block_start + self.block_size
 
-	def get_tx_count_int(self):
-		return self.tx_count
+	def get_prev_hash_little(self):
+		return self.header_bin[4:36]
 
-	def get_version_int(self):
-		return int(self.version.decode('hex')[::-1].encode('hex_codec'), 16)
+	def get_merk_hash_little(self):
+		return self.header_bin[36:68]
 
 	def get_time_int(self):
-		return int(self.start_time.decode('hex')[::-1].encode('hex_codec'), 16)
+		return struct.unpack_from("<I", self.header_bin, 68)[0]
 
 	def get_nBits_int(self):
-		return int(self.nBits.decode('hex')[::-1].encode('hex_codec'), 16)
+		return struct.unpack_from("<I", self.header_bin, 72)[0]
 
-	def get_nonce_int(self):
-		return int(self.nonce.decode('hex')[::-1].encode('hex_codec'), 16)
 
-	def get_merk_hash_little(self):
-		return self.merkle_root_hash
+def get_merkle_parent_level(child_level):
+	# child_level is a packed string of 32 byte hashes
+	# pad the hashes with last hash if count is odd
+	if len(child_level) % 64 == 32:
+		child_level += child_level[-32:]
 
-	def get_merk_hash_big(self):
-		# convert to binary
-		hash_bin = self.merkle_root_hash.decode('hex')
+	# local names skip attribute lookups in the hot loop
+	sha256 = hashlib.sha256
 
-		# big-endian hash
-		hash_hex = hash_bin[::-1].encode('hex_codec')
+	# SHA256(SHA256(hash | hash)) for each children pair, sliced straight from the packed level
+	parent_level = b"".join([sha256(sha256(child_level[i: i + 64]).digest()).digest()
+							for i in xrange(0, len(child_level), 64)])
 
-		return hash_hex
-
-	def get_prev_hash_little(self):
-		return self.previous_block_header_hash
-
-	def get_prev_hash_big(self):
-		# convert to binary
-		hash_bin = self.previous_block_header_hash.decode('hex')
-
-		# big-endian hash
-		hash_hex = hash_bin[::-1].encode('hex_codec')
-
-		return hash_hex
-
-	def get_curr_hash_little(self):
-		# header in little-endian hex
-		header_hex = (self.version + self.previous_block_header_hash + self.merkle_root_hash + 
-			self.start_time + self.nBits + self.nonce)
-
-		# convert to binary
-		header_bin = header_hex.decode('hex')
-
-		# SHA256(SHA256(header))
-		header_hash = hashlib.sha256(hashlib.sha256(header_bin).digest()).digest()
-
-		# little-endian hash
-		hash_little = header_hash.encode('hex_codec')
-
-		return hash_little
-
-	def get_curr_hash_big(self):
-		# header in little-endian hex
-		header_hex = (self.version + self.previous_block_header_hash + self.merkle_root_hash + 
-			self.start_time + self.nBits + self.nonce)
-
-		# convert to binary
-		header_bin = header_hex.decode('hex')
-
-		# SHA256(SHA256(header))
-		header_hash = hashlib.sha256(hashlib.sha256(header_bin).digest()).digest()
-
-		# big-endian hash
-		hash_big = header_hash[::-1].encode('hex_codec')
-
-		return hash_big
+	return child_level, parent_level
 
 
 def get_merkle_tree(leaf_hashes):
-	# construct merkle tree bottom-up
+	# leaf_hashes is a packed string of 32 byte little endian hashes
+	# each merkle tree level is returned as a packed string, padded to an even count
 	merkle_tree = []
-	child_hashes = leaf_hashes
+	child_level = leaf_hashes
 
 	# bottom-up merkle hashing for each merkle tree level
-	while len(child_hashes) > 1:
-		parent_hashes = []
-
-		# pad the hashes with last hash if length is odd
-		if len(child_hashes) % 2 == 1:
-			child_hashes += [child_hashes[len(child_hashes) - 1]]
-
+	while len(child_level) > 32:
 		# append the padded merkle tree level
-		merkle_tree += [child_hashes]
+		child_level, parent_level = get_merkle_parent_level(child_level)
+		merkle_tree += [child_level]
 
-		# number of pairs of children
-		num_pair = len(child_hashes) / 2
+		# compute next level
+		child_level = parent_level
 
-		# compute parent hash for each children pair hashes
-		for i in range(0, num_pair):
-			child_1 = child_hashes[i * 2]
-			child_2 = child_hashes[i * 2 + 1]
+	# append the merkle root
+	merkle_tree += [child_level]
 
-			# convert to binary data
-			child_1_bin = child_1.decode('hex')
-			child_2_bin = child_2.decode('hex')
+	return merkle_tree
 
-			# SHA256(SHA256(hash | hash))
-			parent_bin = hashlib.sha256(hashlib.sha256(child_1_bin + child_2_bin).digest()).digest()
 
-			# little-endian hash
-			parent = parent_bin.encode('hex_codec')
+def get_merkle_root(leaf_hashes):
+	# same as the last level of get_merkle_tree, but only one level is alive at a time
+	child_level = leaf_hashes
 
-			parent_hashes += [parent]
+	while len(child_level) > 32:
+		child_level = get_merkle_parent_level(child_level)[1]
 
-		# compute next level
-		child_hashes = parent_hashes
+	return child_level
 
-	# append the merkle root
-	merkle_tree += [child_hashes]
 
-	return merkle_tree
+def get_merkle_node(merkle_level, pos):
+	# hash at a position of a packed merkle tree level
+	return merkle_level[pos * 32: pos * 32 + 32]
 
 
 def parse_var_len_int(block, nth_byte):
 	# variable length integer: 1, 3, 5, or 9 bytes
+	# fields are unpacked in place so block can be a memory-mapped file
 	num_byte_parsed = 0
 	data = 0
 
 	# parse first byte
-	first_byte = struct.unpack("<B", block[nth_byte: nth_byte + 1])[0]
+	first_byte = struct.unpack_from("<B", block, nth_byte)[0]
 	if first_byte < 0xFD:
 		data = first_byte
 		num_byte_parsed = 1
 
 	elif first_byte == 0xFD:
-		data = struct.unpack("<H", block[nth_byte + 1: nth_byte + 3])[0]
+		data = struct.unpack_from("<H", block, nth_byte + 1)[0]
 		num_byte_parsed = 3
 
 	elif first_byte == 0xFE:
-		data = struct.unpack("<I", block[nth_byte + 1: nth_byte + 5])[0]
+		data = struct.unpack_from("<I", block, nth_byte + 1)[0]
 		num_byte_parsed = 5
 
 	elif first_byte == 0xFF:
-		data = struct.unpack("<Q", block[nth_byte + 1: nth_byte + 9])[0]
+		data = struct.unpack_from("<Q", block, nth_byte + 1)[0]
 		num_byte_parsed = 9
 
 	else:
@@ -329,6 +337,18 @@ def parse_var_len_int(block, nth_byte):
 	return data, num_byte_parsed
 
 
+def to_var_len_int(data):
+	# variable length integer: 1, 3, 5, or 9 bytes
+	if data < 0xFD:
+		return struct.pack("<B", data)
+	elif data <= 0xFFFF:
+		return struct.pack("<BH", 0xFD, data)
+	elif data <= 0xFFFFFFFF:
+		return struct.pack("<BI", 0xFE, data)
+	else:
+		return struct.pack("<BQ", 0xFF, data)
+
+
 def byte_to_hex_string_little(bytes):
 	# hex string little endian
 	return  binascii.hexlify(bytes)
@@ -339,220 +359,368 @@ def byte_to_hex_string_big(bytes):
 	return  binascii.hexlify(bytes[::-1])
 
 
-def parse_block(blockchain_data, nth_byte):
+def parse_transaction(blockchain_data, nth_byte, i, filter_items=None, script_index_entries=None, end_byte=None):
+	# parse the ith transaction of a block starting at nth_byte
+	# end_byte is the end of the block, counts and scripts that run past it fail the assertions
+	# filter_items collects output scripts and spent outpoints, if given
+	# script_index_entries collects (key, tx_index, io_index) of the script index, if given
+
+	# start index of transaction
+	start_tx_byte = nth_byte
+
+	if end_byte is None:
+		end_byte = len(blockchain_data)
+
+	# walk the transaction by offsets only, the raw bytes are hashed in place afterwards
+
+	# transaction version number
+	nth_byte += 4
+
+	# input transaction count
+	input_tx_count, num_byte_parsed = parse_var_len_int(blockchain_data, nth_byte)
+	nth_byte += num_byte_parsed
+
+	# make sure the inputs fit in the block before looping over them
+	assert (input_tx_count <= (end_byte - nth_byte) / MIN_INPUT_SIZE)
+
+	# parse each input transaction
+	for j in xrange(0, input_tx_count):
+		# txid of the transaction holding the output to spend
+		# output index number of the specific output to spend from the transaction
+		if filter_items is not None or script_index_entries is not None:
+			outpoint = blockchain_data[nth_byte: nth_byte + 32 + 4]
+			if outpoint != block_filter.NULL_OUTPOINT:
+				if filter_items is not None:
+					filter_items += [outpoint]
+				if script_index_entries is not None:
+					script_index_entries += [(script_index.get_outpoint_key(outpoint), i, j)]
+		nth_byte += 32 + 4
+
+		# script size
+		script_size, num_byte_parsed = parse_var_len_int(blockchain_data, nth_byte)
+		nth_byte += num_byte_parsed
+
+		# script that satisfies the conditions placed in the outpoint's pubkey script
+		# sequence number
+		assert (nth_byte + script_size + 4 <= end_byte)
+		nth_byte += script_size + 4
+
+	# output transaction count
+	output_tx_count, num_byte_parsed = parse_var_len_int(blockchain_data, nth_byte)
+	nth_byte += num_byte_parsed
+
+	# make sure the outputs fit in the block before looping over them
+	assert (output_tx_count <= (end_byte - nth_byte) / MIN_OUTPUT_SIZE)
+
+	# parse each output transaction
+	for j in xrange(0, output_tx_count):
+		# amount of satoshis to spend
+		nth_byte += 8
+
+		# script size
+		script_size, num_byte_parsed = parse_var_len_int(blockchain_data, nth_byte)
+		nth_byte += num_byte_parsed
+		assert (nth_byte + script_size <= end_byte)
+
+		# script that satisfies the conditions placed in the outpoint's pubkey script
+		# empty and OP_RETURN scripts cannot be spent, so wallets never look for them
+		if filter_items is not None and script_size > 0 and blockchain_data[nth_byte] != b"\x6a":
+			filter_items += [blockchain_data[nth_byte: nth_byte + script_size]]
+		if script_index_entries is not None:
+			script_key = script_index.get_script_key(buffer(blockchain_data, nth_byte, script_size))
+			script_index_entries += [(script_key, i, j)]
+		nth_byte += script_size
+
+	# time (Unix epoch time) or block number
+	nth_byte += 4
+
+	# number of bytes of this raw transaction
+	tx_size = nth_byte - start_tx_byte
+
+	# SHA256(SHA256(raw transaction))
+	# hash the raw transaction bytes in place, without copying them out of the block
+	# little-endian hash
+	tx_hash_little = hashlib.sha256(hashlib.sha256(buffer(blockchain_data, start_tx_byte, tx_size)).digest()).digest()
+	#print(tx_hash_little)
+
+	return tx_hash_little, nth_byte
+
+
+def parse_block(blockchain_data, nth_byte, nth_file=0, with_filter_items=False, with_script_entries=False):
+	# parse the block record starting at nth_byte into a BlockRecord, without touching any index
+	# with_filter_items collects output scripts and spent outpoints for the block filter
+	# with_script_entries collects (key, tx_index, io_index) for the script index
+
 	# magic number 0xD9B4BEF9
-	# 4 bytes little endian to hex big endian
-	magic_num = byte_to_hex_string_big(blockchain_data[nth_byte: nth_byte + 4])
+	# 4 bytes little endian to int
+	magic_num = struct.unpack_from("<I", blockchain_data, nth_byte)[0]
 	#print (magic_num)
 	# make sure block parsed correctly
-	assert (magic_num == b'd9b4bef9')
+	assert (magic_num == MAGIC_NUM)
 	nth_byte += 4
 
 	# block size
 	# 4 bytes little endian to int
-	block_size = struct.unpack("<I", blockchain_data[nth_byte: nth_byte + 4])[0]
+	block_size = struct.unpack_from("<I", blockchain_data, nth_byte)[0]
 	#print block_size
 	nth_byte += 4
 	# start index of the block
 	start_block_byte = nth_byte
 
-	# version number
-	ver_num = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + 4])
-	#print ver_num
-	nth_byte += 4
-
-	# previous block's header hash
-	prev_hash = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + 32])
-	#print prev_hash
-	nth_byte += 32
-
-	# merkle root hash
-	merk_hash = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + 32])
-	#print merk_hash
-	nth_byte += 32
-
-	# Unix epoch time
-	start_time = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + 4])
-	#print start_time
-	nth_byte += 4
-
-	# target difficulty threshold
-	nBits = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + 4])
-	#print nBits
-	nth_byte += 4
-
-	# arbitrary number to match difficulty
-	nonce = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + 4])
-	#print nonce
-	nth_byte += 4
+	# version number, previous block's header hash, merkle root hash,
+	# Unix epoch time, target difficulty threshold, nonce
+	header_bin = blockchain_data[nth_byte: nth_byte + 80]
+	nth_byte += 80
 
 	# transaction count
 	tx_count, num_byte_parsed = parse_var_len_int(blockchain_data, nth_byte)
 	nth_byte += num_byte_parsed
 	#print(tx_count)
 
+	# end index of the block
+	end_block_byte = start_block_byte + block_size
+
+	# make sure the transactions fit in the block before looping over them
+	assert (tx_count <= (end_block_byte - nth_byte) / MIN_TX_SIZE)
+
+	# output scripts and spent outpoints of the block
+	filter_items = [] if with_filter_items else None
+
+	# script index keys of the block, (key, tx_index, io_index)
+	script_index_entries = [] if with_script_entries else None
+
+	# byte offset of each transaction in the file
+	tx_offsets = []
 	# list of all transaction hashes
 	tx_hashes = []
-	# list of all transactions
-	transactions = []
 
 	# parse each transaction
-	for i in range(0, tx_count):
-		# start index of transaction
-		start_tx_byte = nth_byte
-		# raw transaction data concatenated to compute txid
-		raw_tx_data = ""
+	for i in xrange(0, tx_count):
+		tx_offsets += [nth_byte]
+		tx_hash_little, nth_byte = parse_transaction(blockchain_data, nth_byte, i, filter_items,
+													script_index_entries, end_block_byte)
+		tx_hashes += [tx_hash_little]
 
-		# transaction version number
-		tx_ver_num = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + 4])
-		raw_tx_data += tx_ver_num
-		nth_byte += 4
+	# make sure the bytes transactions and header are parsed correctly
+	assert (nth_byte - start_block_byte == block_size)
 
-		# input transaction count
-		input_tx_count, num_byte_parsed = parse_var_len_int(blockchain_data, nth_byte)
-		raw_tx_data += byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + num_byte_parsed])
-		nth_byte += num_byte_parsed
+	# SHA256(SHA256(header))
+	block_hash = hashlib.sha256(hashlib.sha256(header_bin).digest()).digest()
 
-		# list of all input transactions
-		input_transactions = []
-
-		# parse each input transaction
-		for j in range(0, input_tx_count):
-			# txid of the transaction holding the output to spend
-			prev_tx_hash = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + 32])
-			raw_tx_data += prev_tx_hash
-			nth_byte += 32
-
-			# output index number of the specific output to spend from the transaction
-			prev_tx_index = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + 4])
-			raw_tx_data += prev_tx_index
-			nth_byte += 4
-
-			# script size
-			script_size, num_byte_parsed = parse_var_len_int(blockchain_data, nth_byte)
-			raw_tx_data += byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + num_byte_parsed])
-			nth_byte += num_byte_parsed
-
-			# script that satisfies the conditions placed in the outpoint's pubkey script
-			script = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + script_size])
-			raw_tx_data += byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + script_size])
-			nth_byte += script_size
-
-			# sequence number
-			seq_num = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + 4])
-			raw_tx_data += seq_num
-			nth_byte += 4
-
-			# new input transaction
-			input_tx = InputTransaction(prev_tx_hash, script, seq_num)
-			input_transactions += [input_tx]
-
-		# output transaction count
-		output_tx_count, num_byte_parsed = parse_var_len_int(blockchain_data, nth_byte)
-		raw_tx_data += byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + num_byte_parsed])
-		nth_byte += num_byte_parsed
+	return BlockRecord(nth_file, start_block_byte, block_size, header_bin, block_hash,
+					tx_offsets, b"".join(tx_hashes), filter_items, script_index_entries)
 
-		# list of all output transactions
-		output_transactions = []
 
-		# parse each output transaction
-		for j in range(0, output_tx_count):
-			# amount of satoshis to spend
-			satoshi_amount = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + 8])
-			raw_tx_data += satoshi_amount
-			nth_byte += 8
+def find_next_block(blockchain_data, nth_byte):
+	# byte offset of the next magic number from nth_byte, or -1 if there is none
+	return blockchain_data.find(MAGIC_BYTES, nth_byte)
 
-			# script size
-			script_size, num_byte_parsed = parse_var_len_int(blockchain_data, nth_byte)
-			raw_tx_data += byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + num_byte_parsed])
-			nth_byte += num_byte_parsed
 
-			# script that satisfies the conditions placed in the outpoint's pubkey script
-			script = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + script_size])
-			raw_tx_data += byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + script_size])
-			nth_byte += script_size
+def iter_file_blocks(blockchain_dat_filename, nth_file=0, header_start=0,
+					with_filter_items=False, with_script_entries=False):
+	# lazily yield a BlockRecord for every complete block of a .dat file from header_start
+	# only one block is parsed at a time, records do not reference the mapped file
+	# zero padding and malformed records are skipped by resyncing on the next magic number
 
-			# new output transaction
-			output_tx = OutputTransaction(satoshi_amount, script)
-			output_transactions += [output_tx]
+	try:
+		# get the file size
+		file_end = os.stat(blockchain_dat_filename).st_size
 
-		# time (Unix epoch time) or block number
-		locktime = byte_to_hex_string_little(blockchain_data[nth_byte: nth_byte + 4])
-		raw_tx_data += locktime
-		nth_byte += 4
+		# nothing new to map
+		if file_end <= header_start:
+			return
+
+		# open .dat file to load blocks
+		blockchain_dat = open(blockchain_dat_filename, "rb")
+	except (IOError, OSError):
+		# file was pruned by the node
+		print("Skipped missing " + blockchain_dat_filename)
+		return
+
+	with blockchain_dat:
+		# map the file read-only instead of reading it into memory,
+		# so fields are unpacked straight from the page cache
+		blockchain_data = mmap.mmap(blockchain_dat.fileno(), 0, access=mmap.ACCESS_READ)
+
+		try:
+			# parse every complete block
+			# size(magic_num) + size(block_size)
+			while header_start + (4 + 4) <= file_end:
+				magic_num, block_size = struct.unpack_from("<II", blockchain_data, header_start)
+
+				if magic_num != MAGIC_NUM:
+					# zero padding or a misaligned record, resync on the next block
+					next_start = find_next_block(blockchain_data, header_start + 1)
+
+					# rest of the file is preallocated space the node has not written yet
+					if next_start == -1:
+						break
+
+					if magic_num != 0:
+						print("Skipped " + str(next_start - header_start) + " bytes at " +
+							str(header_start) + " of " + blockchain_dat_filename)
+					header_start = next_start
+					continue
+
+				if header_start + (4 + 4) + block_size > file_end:
+					# block is still being written by the node, unless another block follows it
+					next_start = find_next_block(blockchain_data, header_start + 4)
+					if next_start == -1:
+						break
+
+					print("Skipped truncated block at " + str(header_start) + " of " + blockchain_dat_filename)
+					header_start = next_start
+					continue
+
+				try:
+					record = parse_block(blockchain_data, header_start, nth_file, with_filter_items, with_script_entries)
+				except (AssertionError, struct.error):
+					# block size does not match its transactions, resync on the next block
+					print("Skipped malformed block at " + str(header_start) + " of " + blockchain_dat_filename)
+					next_start = find_next_block(blockchain_data, header_start + 4)
+					if next_start == -1:
+						break
+
+					header_start = next_start
+					continue
+
+				yield record
+
+				# size(magic_num) + size(block_size) + block_size
+				header_start += (4 + 4 + block_size)
+		finally:
+			blockchain_data.close()
 
-		# number of bytes of this raw transaction
-		tx_size = (start_tx_byte - nth_byte)
+	return
 
-		# convert to binary
-		raw_tx_data_bin = raw_tx_data.decode('hex')
 
-		# SHA256(SHA256(raw transaction))
-		tx_hash_bin = hashlib.sha256(hashlib.sha256(raw_tx_data_bin).digest()).digest()
+def iter_blocks(directory_path, nth_file=0, header_start=0,
+				with_filter_items=False, with_script_entries=False):
+	# lazily yield a BlockRecord for every complete block of the blk*.dat files of a directory,
+	# from header_start of the nth file, skipping files the node pruned
+	for file_number in get_file_numbers(directory_path):
+		if file_number < nth_file:
+			continue
 
-		# little-endian hash
-		tx_hash_little = tx_hash_bin.encode('hex_codec')
-		#print(tx_hash_little)
-		tx_hashes += [tx_hash_little]
+		# parse the checkpoint file from where it stopped and later files from the start
+		file_start = header_start if file_number == nth_file else 0
 
-		# new transaction
-		#tx = Transaction(tx_hash_little, tx_ver_num, input_tx_count, input_transactions,
-						#output_tx_count, output_transactions, locktime)
-		#transactions += [tx]
+		for record in iter_file_blocks(get_filename(directory_path, file_number), file_number, file_start,
+									with_filter_items, with_script_entries):
+			yield record
 
-	# make sure the bytes transactions and header are parsed correctly
-	assert (nth_byte - start_block_byte == block_size)
+	return
 
-	# compute the Merkle tree of all transactions
-	merkle_tree = get_merkle_tree(tx_hashes)
 
-	# verify the merkle root hash in block header, last hash in merkle tree is root
-	assert (merk_hash == merkle_tree[len(merkle_tree) - 1][0])
+def validate_merkle_root(record):
+	# verify the merkle root hash in block header
+	if record.get_merk_hash_little() != get_merkle_root(record.tx_hashes):
+		print("Skipped block " + byte_to_hex_string_big(record.block_hash) + " with invalid merkle root")
+		return False
 
-	# create block
-	block = Block(ver_num, prev_hash, merk_hash, start_time, nBits, nonce, tx_count, transactions, merkle_tree)
+	return True
 
-	# block_hash -> block
-	block_hash_to_block[block.get_curr_hash_little()] = block
 
+def index_transactions(record):
 	# tx_hash -> block_hash, tx_index
-	for i in range(0, len(tx_hashes)):
-		tx_hash_to_block_hash[tx_hashes[i]] = (block.get_curr_hash_little(), i)
-	
-	return block_size
+	for i in range(0, record.tx_count):
+		tx_hash_to_block_hash[record.tx_hashes[i * 32: (i + 1) * 32]] = (record.block_hash, i)
+
+
+def index_block_location(record):
+	# remember where the block is to read it back for merkle proofs
+	block_hash_to_location[record.block_hash] = (record.nth_file, record.block_start, record.block_size)
+
 
+def index_scripts(record):
+	# script key -> block_hash, tx_hash, tx_index, io_index
+	for key, tx_leaf_index, io_index in record.script_index_entries:
+		tx_hash = record.tx_hashes[tx_leaf_index * 32: tx_leaf_index * 32 + 32]
+		packed_record = script_index.pack_record(key, record.block_hash, tx_hash, tx_leaf_index, io_index)
+		script_key_to_records.setdefault(key, []).append(packed_record)
 
-def load_file(blockchain_dat_filename, blockheaders_dat):
+
+def count_block(record):
 	global block_count
 
-	header_start = 0
+	# track total block parsed
+	block_count += 1
 
-	# open .dat file to load blocks
-	with open(blockchain_dat_filename, "rb") as blockchain_dat:
-		blockchain_data = blockchain_dat.read()
-		# get the file size
-		file_end = os.stat(blockchain_dat_filename).st_size
-		
-		# parse every block
-		while True:
-			block_size = parse_block(blockchain_data, header_start)
 
-			# write block headers to file for spv client
-			blockheaders_dat.write(blockchain_data[header_start + 8 : header_start + 88])
+def get_header_writer(blockheaders_dat):
+	# stage writing block headers to file for spv client
+	def write_header(record):
+		blockheaders_dat.write(record.header_bin)
+
+	return write_header
+
+
+def get_filter_writer(blockfilters_dat):
+	# stage writing block filters in the same order as the block headers
+	def write_filter(record):
+		blockfilters_dat.write(block_filter.pack_record(record.block_hash,
+							block_filter.build_filter(record.block_hash, record.filter_items)))
+
+	return write_filter
+
+
+def get_ingest_stages(blockheaders_dat, blockfilters_dat=None):
+	# stages every parsed block goes through when the full node proxy loads blocks
+	stages = [validate_merkle_root, index_transactions, index_block_location]
+
+	if BUILD_SCRIPT_INDEX:
+		stages += [index_scripts]
+
+	stages += [get_header_writer(blockheaders_dat)]
 
-			# track total block parsed
-			block_count += 1
+	if blockfilters_dat is not None:
+		stages += [get_filter_writer(blockfilters_dat)]
 
-			# size(magic_num) + block_size + size(null padding)
-			header_start += (4 + block_size + 4)
+	stages += [count_block]
 
-			# check if file ends
-			# size(magic_num) + size(blocksize) + size(header)
-			if (header_start + (4 + 4 + 80)) >= file_end:
+	return stages
+
+
+def run_stages(records, stages):
+	# feed every record to every stage in one pass, return the last record or None
+	# a stage returning False drops the record from the stages after it
+	record = None
+	for record in records:
+		for stage in stages:
+			if stage(record) is False:
 				break
 
-	blockchain_dat.close()
-	return
+	return record
+
+
+def get_block_tx_hashes(block_data, nth_byte):
+	# packed transaction hashes of a block whose header starts at nth_byte
+	nth_byte += 80
+
+	# transaction count
+	tx_count, num_byte_parsed = parse_var_len_int(block_data, nth_byte)
+	nth_byte += num_byte_parsed
+
+	tx_hashes = []
+	for i in xrange(0, tx_count):
+		tx_hash_little, nth_byte = parse_transaction(block_data, nth_byte, i)
+		tx_hashes += [tx_hash_little]
+
+	return b"".join(tx_hashes)
+
+
+def load_file(blockchain_dat_filename, nth_file, blockheaders_dat, header_start=0, blockfilters_dat=None):
+	# stream blocks of the file through the indexers and writers
+	records = iter_file_blocks(blockchain_dat_filename, nth_file, header_start,
+							blockfilters_dat is not None, BUILD_SCRIPT_INDEX)
+	last_record = run_stages(records, get_ingest_stages(blockheaders_dat, blockfilters_dat))
+
+	# nothing new in this file
+	if last_record is None:
+		return header_start
+
+	# byte offset to resume parsing this file from
+	return last_record.get_end()
 
 
 def get_filename(directory_path, nth_file):
@@ -562,41 +730,599 @@ def get_filename(directory_path, nth_file):
 	return directory_path + "blk" + nth_file_string + ".dat"
 
 
-def load_blockchain(directory_path):
-	nth_file = 0
-	# load all .dat files in given directory path
-	blockchain_dat_filename = get_filename(directory_path, nth_file)
+def get_file_numbers(directory_path):
+	# sorted numbers of the blk*.dat files in a directory, pruned files leave gaps
+	file_numbers = []
+	for filename in os.listdir(directory_path or "."):
+		if filename.startswith("blk") and filename.endswith(".dat") and filename[3:-4].isdigit():
+			file_numbers += [int(filename[3:-4])]
+
+	return sorted(file_numbers)
+
+
+def load_file_worker(file_args):
+	# runs in a worker process, which has its own copy of the module indexes
+	blockchain_dat_filename, nth_file = file_args
+	tx_hash_to_block_hash.clear()
+	block_hash_to_location.clear()
+	script_key_to_records.clear()
+
+	# collect block headers and block filters in memory to hand back to the parent process
+	blockheaders_dat = io.BytesIO()
+	blockfilters_dat = io.BytesIO() if BUILD_BLOCK_FILTERS else None
+	header_end = load_file(blockchain_dat_filename, nth_file, blockheaders_dat, 0, blockfilters_dat)
+
+	file_blockfilters = blockfilters_dat.getvalue() if blockfilters_dat is not None else b""
+
+	return (tx_hash_to_block_hash, block_hash_to_location, script_key_to_records,
+			blockheaders_dat.getvalue(), file_blockfilters, header_end)
+
+
+def save_checkpoint(nth_file, header_start):
+	# write to a temporary file first so a crash never leaves a torn checkpoint
+	with open(CHECKPOINT_FILENAME + ".tmp", "w") as checkpoint_dat:
+		json.dump({"nth_file": nth_file, "header_start": header_start, "indexed": indexed_checkpoint,
+					"block_filters": BUILD_BLOCK_FILTERS, "script_index": BUILD_SCRIPT_INDEX},
+				checkpoint_dat)
+
+	os.rename(CHECKPOINT_FILENAME + ".tmp", CHECKPOINT_FILENAME)
+	return
+
+
+def load_checkpoint():
+	# nothing parsed yet
+	if not os.path.isfile(CHECKPOINT_FILENAME):
+		return 0, 0
+
+	with open(CHECKPOINT_FILENAME, "r") as checkpoint_dat:
+		checkpoint = json.load(checkpoint_dat)
+
+	return checkpoint["nth_file"], checkpoint["header_start"]
+
+
+def load_indexed_checkpoint():
+	# nth_file, header_start, header_count, filters_size of the last time every index was on disk
+	with open(CHECKPOINT_FILENAME, "r") as checkpoint_dat:
+		checkpoint = json.load(checkpoint_dat)
+
+	if checkpoint.get("indexed") is not None:
+		return checkpoint["indexed"]
+
+	# checkpoint of a version that flushed every index before moving it
+	return [checkpoint["nth_file"], checkpoint["header_start"], get_block_header_count(), get_filters_size()]
+
+
+def has_script_index():
+	# whether the indexes on disk come with the scripts of every block
+	with open(CHECKPOINT_FILENAME, "r") as checkpoint_dat:
+		checkpoint = json.load(checkpoint_dat)
+
+	# checkpoint of a version that did not record it built the index whenever the file exists
+	built = checkpoint.get("script_index", True)
+
+	return built and os.path.isfile(SCRIPT_INDEX_FILENAME)
+
+
+def has_block_filters():
+	# whether the indexes on disk come with filters of every block
+	with open(CHECKPOINT_FILENAME, "r") as checkpoint_dat:
+		checkpoint = json.load(checkpoint_dat)
+
+	# checkpoint of a version that did not record it built filters whenever the file exists
+	built = checkpoint.get("block_filters", True)
+
+	return built and os.path.isfile(block_filter.FILTERS_FILENAME)
+
+
+def get_filters_size():
+	# bytes of the filters file, 0 if it is not built
+	if not BUILD_BLOCK_FILTERS or not os.path.isfile(block_filter.FILTERS_FILENAME):
+		return 0
+
+	return os.path.getsize(block_filter.FILTERS_FILENAME)
+
+
+def truncate_file(filename, size):
+	# drop bytes past size, written after the last checkpoint
+	if os.path.isfile(filename) and os.path.getsize(filename) > size:
+		with open(filename, "r+b") as dat:
+			dat.truncate(size)
+
+	return
+
+
+def flush_index(index_module, index_filename, in_memory_index, runs):
+	# nothing to flush
+	if len(in_memory_index) == 0:
+		return
+
+	# write the in-memory index as a sorted run and free it
+	run_filename = index_filename + ".run" + str(len(runs))
+	index_module.index.write_run(run_filename, index_module.pack_records(in_memory_index))
+	runs += [run_filename]
+	in_memory_index.clear()
+
+	return
+
+
+def merge_index(index_module, index_filename, in_memory_index, runs, merge_old):
+	# merge sorted runs and the in-memory index into the on-disk index of an index module
+	runs = list(runs)
+	if len(in_memory_index) > 0:
+		run_filename = index_filename + ".run" + str(len(runs))
+		index_module.index.write_run(run_filename, index_module.pack_records(in_memory_index))
+		runs += [run_filename]
+
+	# the previous index merges first, so the runs of this call win
+	# the old index stays mapped for readers until the new one is opened
+	if merge_old and os.path.isfile(index_filename):
+		os.rename(index_filename, index_filename + ".old")
+		runs = [index_filename + ".old"] + runs
+
+	index_module.index.merge_runs(runs, index_filename + ".tmp")
+	os.rename(index_filename + ".tmp", index_filename)
+	index_module.index.open(index_filename)
+
+	# entries are now served from disk
+	in_memory_index.clear()
+
+	return
+
+
+def load_blockchain(directory_path, num_processes=1):
+	global block_count
+	global blockchain_directory
+
+	# blocks are read back from the .dat files of this directory
+	blockchain_directory = directory_path
+
+	# sorted runs of the transaction index written so far
+	tx_index_runs = []
+
+	# sorted runs of the script index written so far
+	script_index_runs = []
+
+	# find all .dat files in given directory path, a pruned node has deleted its oldest files
+	file_numbers = get_file_numbers(directory_path)
+	blockchain_dat_filenames = [get_filename(directory_path, nth_file) for nth_file in file_numbers]
 
 	# write block headers to file
-	blockheaders_dat = open("blockheaders.dat", "wb")
+	blockheaders_dat = open(BLOCK_HEADERS_FILENAME, "wb")
+
+	# write block filters to file
+	blockfilters_dat = None
+	if BUILD_BLOCK_FILTERS:
+		block_filter.reset_filters()
+		blockfilters_dat = open(block_filter.FILTERS_FILENAME, "wb")
+
+	# byte offset parsed in the last file
+	header_end = 0
+
+	if num_processes > 1:
+		# parse files concurrently in worker processes
+		pool = multiprocessing.Pool(num_processes)
+
+		try:
+			# imap hands results back in file order, so later blocks still win on merge
+			results = pool.imap(load_file_worker, zip(blockchain_dat_filenames, file_numbers))
+
+			for blockchain_dat_filename, result in zip(blockchain_dat_filenames, results):
+				(file_tx_hash_to_block_hash, file_block_hash_to_location, file_script_key_to_records,
+					file_blockheaders, file_blockfilters, header_end) = result
+
+				# merge the per-file indexes
+				tx_hash_to_block_hash.update(file_tx_hash_to_block_hash)
+				block_hash_to_location.update(file_block_hash_to_location)
+				for key in file_script_key_to_records:
+					script_key_to_records.setdefault(key, []).extend(file_script_key_to_records[key])
+
+				# append the per-file header stream
+				blockheaders_dat.write(file_blockheaders)
+				if blockfilters_dat is not None:
+					blockfilters_dat.write(file_blockfilters)
+
+				# track total block parsed
+				block_count += len(file_blockheaders) / 80
+
+				# bound the memory of the transaction index and script index
+				if len(tx_hash_to_block_hash) >= TX_INDEX_FLUSH_SIZE:
+					flush_index(tx_index, TX_INDEX_FILENAME, tx_hash_to_block_hash, tx_index_runs)
+				if len(script_key_to_records) >= TX_INDEX_FLUSH_SIZE:
+					flush_index(script_index, SCRIPT_INDEX_FILENAME, script_key_to_records, script_index_runs)
+
+				print ("Parsed " + blockchain_dat_filename)
+		finally:
+			pool.close()
+			pool.join()
 
-	# load every file
-	while os.path.isfile(blockchain_dat_filename):
-		load_file(blockchain_dat_filename, blockheaders_dat)
+	else:
+		# load every file
+		for blockchain_dat_filename, nth_file in zip(blockchain_dat_filenames, file_numbers):
+			header_end = load_file(blockchain_dat_filename, nth_file, blockheaders_dat, 0, blockfilters_dat)
 
-		print ("Parsed " + blockchain_dat_filename)
+			# bound the memory of the transaction index and script index
+			if len(tx_hash_to_block_hash) >= TX_INDEX_FLUSH_SIZE:
+				flush_index(tx_index, TX_INDEX_FILENAME, tx_hash_to_block_hash, tx_index_runs)
+			if len(script_key_to_records) >= TX_INDEX_FLUSH_SIZE:
+				flush_index(script_index, SCRIPT_INDEX_FILENAME, script_key_to_records, script_index_runs)
 
-		# parse next file
-		nth_file += 1
-		blockchain_dat_filename = get_filename(directory_path, nth_file)
+			print ("Parsed " + blockchain_dat_filename)
 
 	blockheaders_dat.close()
+	if blockfilters_dat is not None:
+		blockfilters_dat.close()
+
+	# node stores blocks in the order they arrive, spv clients want them in chain order
+	order_block_headers()
+	block_count = get_block_header_count()
+
+	# serve the block filters
+	if blockfilters_dat is not None:
+		block_filter.index_filters()
+
+	# merge all sorted runs into the transaction index and script index,
+	# entries of blocks parsed again merge into the index of a previous run
+	merge_index(tx_index, TX_INDEX_FILENAME, tx_hash_to_block_hash, tx_index_runs, True)
+	if BUILD_SCRIPT_INDEX:
+		merge_index(script_index, SCRIPT_INDEX_FILENAME, script_key_to_records, script_index_runs, True)
+
+	# write the block locations to disk
+	# blocks of a previous run may have been pruned from the node's files, so its index is dropped
+	merge_index(block_index, BLOCK_INDEX_FILENAME, block_hash_to_location, [], False)
+
+	# remember where the node's files end to sync new blocks from there
+	# every index is on disk
+	global indexed_checkpoint
+	indexed_checkpoint = [file_numbers[-1] if file_numbers else 0, header_end,
+						get_block_header_count(), get_filters_size()]
+	save_checkpoint(indexed_checkpoint[0], indexed_checkpoint[1])
+
+	return
+
+
+def flush_indexes():
+	global indexed_checkpoint
+
+	# write every in-memory index to disk, so a restart resumes from the last synced block
+	if len(tx_hash_to_block_hash) > 0:
+		merge_index(tx_index, TX_INDEX_FILENAME, tx_hash_to_block_hash, [], True)
+	if BUILD_SCRIPT_INDEX and len(script_key_to_records) > 0:
+		merge_index(script_index, SCRIPT_INDEX_FILENAME, script_key_to_records, [], True)
+	if len(block_hash_to_location) > 0:
+		merge_index(block_index, BLOCK_INDEX_FILENAME, block_hash_to_location, [], True)
+
+	nth_file, header_start = load_checkpoint()
+	indexed_checkpoint = [nth_file, header_start, get_block_header_count(), get_filters_size()]
+	save_checkpoint(nth_file, header_start)
+
+	return
+
+
+def get_linked_order(headers_data):
+	# rows of raw 80 byte headers ordered so every header follows its previous block's header
+	# a header whose previous block is not among them starts a chain, chains keep the parsed order
+	# None if the headers are already in that order
+	header_count = len(headers_data) / 80
+
+	# headers parsed in chain order need no index, check that first
+	last_hash = None
+	for row in xrange(0, header_count):
+		header_bin = headers_data[row * 80: (row + 1) * 80]
+		if last_hash is not None and header_bin[4:36] != last_hash:
+			break
+
+		last_hash = hashlib.sha256(hashlib.sha256(header_bin).digest()).digest()
+	else:
+		return None
+
+	# header hash -> row, the node may have stored a block twice
+	hash_to_row = {}
+	for row in xrange(0, header_count):
+		header_bin = headers_data[row * 80: (row + 1) * 80]
+		header_hash = hashlib.sha256(hashlib.sha256(header_bin).digest()).digest()
+		if header_hash not in hash_to_row:
+			hash_to_row[header_hash] = row
+
+	# link every header to its previous block's header
+	first_rows = []
+	row_to_children = {}
+	for row in sorted(hash_to_row.values()):
+		parent_row = hash_to_row.get(headers_data[row * 80 + 4: row * 80 + 36])
+		if parent_row is None:
+			first_rows += [row]
+		else:
+			row_to_children.setdefault(parent_row, []).append(row)
+
+	# depth-first from the first header of every chain, so a chain stays contiguous
+	order = []
+	stack = first_rows[::-1]
+	while stack:
+		row = stack.pop()
+		order += [row]
+		stack += row_to_children.get(row, [])[::-1]
+
+	if order == range(0, header_count):
+		return None
+
+	return order
+
+
+def order_block_headers():
+	# rewrite the headers file and filters file in chain order, if blocks were parsed out of order
+	with open(BLOCK_HEADERS_FILENAME, "rb") as blockheaders_dat:
+		headers_data = blockheaders_dat.read()
+
+	order = get_linked_order(headers_data)
+	if order is None:
+		return
+
+	print("Order block headers...")
+
+	with open(BLOCK_HEADERS_FILENAME + ".tmp", "wb") as blockheaders_dat:
+		for row in order:
+			blockheaders_dat.write(headers_data[row * 80: (row + 1) * 80])
+
+	if BUILD_BLOCK_FILTERS:
+		# filter records vary in size, find where each one ends first
+		block_filter.reset_filters()
+		block_filter.index_filters()
+		filter_ends = block_filter.filter_ends
+
+		with open(block_filter.FILTERS_FILENAME, "rb") as blockfilters_dat:
+			with open(block_filter.FILTERS_FILENAME + ".tmp", "wb") as ordered_blockfilters_dat:
+				for row in order:
+					start_offset = filter_ends[row - 1] if row > 0 else 0
+					blockfilters_dat.seek(start_offset)
+					ordered_blockfilters_dat.write(blockfilters_dat.read(filter_ends[row] - start_offset))
+
+		# filters file is about to be replaced
+		block_filter.reset_filters()
+		os.rename(block_filter.FILTERS_FILENAME + ".tmp", block_filter.FILTERS_FILENAME)
+
+	os.rename(BLOCK_HEADERS_FILENAME + ".tmp", BLOCK_HEADERS_FILENAME)
+
+	return
+
+
+def write_linked_headers(headers_data, filters_data, blockheaders_dat, blockfilters_dat=None):
+	# append newly parsed headers and filters in chain order
+	order = get_linked_order(headers_data)
+	if order is None:
+		blockheaders_dat.write(headers_data)
+		if blockfilters_dat is not None:
+			blockfilters_dat.write(filters_data)
+		return
+
+	filter_records = block_filter.parse_filter_records(filters_data) if blockfilters_dat is not None else None
+	for row in order:
+		blockheaders_dat.write(headers_data[row * 80: (row + 1) * 80])
+		if blockfilters_dat is not None:
+			blockfilters_dat.write(block_filter.pack_record(*filter_records[row]))
+
+	return
+
+
+def sync_blockchain(directory_path):
+	global block_count
+
+	# resume from the last file and byte offset parsed
+	nth_file, header_start = load_checkpoint()
+
+	# collect new block headers and block filters in memory to put them in chain order
+	new_blockheaders = io.BytesIO()
+	new_blockfilters = io.BytesIO() if BUILD_BLOCK_FILTERS else None
+
+	# parse new blocks appended to the last file and any files the node started since
+	records = iter_blocks(directory_path, nth_file, header_start,
+						new_blockfilters is not None, BUILD_SCRIPT_INDEX)
+	last_record = run_stages(records, get_ingest_stages(new_blockheaders, new_blockfilters))
+
+	# resume after the last block parsed
+	if last_record is not None:
+		nth_file, header_start = last_record.nth_file, last_record.get_end()
+
+	# append only new block headers and block filters
+	blockheaders_dat = open(BLOCK_HEADERS_FILENAME, "ab")
+	blockfilters_dat = open(block_filter.FILTERS_FILENAME, "ab") if BUILD_BLOCK_FILTERS else None
+
+	try:
+		write_linked_headers(new_blockheaders.getvalue(),
+							new_blockfilters.getvalue() if new_blockfilters is not None else b"",
+							blockheaders_dat, blockfilters_dat)
+	finally:
+		blockheaders_dat.close()
+		if blockfilters_dat is not None:
+			blockfilters_dat.close()
+
+	block_count = get_block_header_count()
+
+	# serve the new block filters
+	if blockfilters_dat is not None:
+		block_filter.index_filters()
+
+	# headers are on disk before the checkpoint moves past them
+	save_checkpoint(nth_file, header_start)
+
+	# bound the memory of the in-memory indexes, all of them move to disk together
+	# so the indexed checkpoint covers every index
+	if (len(tx_hash_to_block_hash) >= TX_INDEX_FLUSH_SIZE or
+		len(script_key_to_records) >= TX_INDEX_FLUSH_SIZE or
+		len(block_hash_to_location) >= TX_INDEX_FLUSH_SIZE):
+		flush_indexes()
+
 	return
 
 
-def setup(directory_path):
+def get_block_headers(start_row, max_count):
+	# read at most max_count raw headers from the nth header of the headers file
+	with open(BLOCK_HEADERS_FILENAME, "rb") as blockheaders_dat:
+		blockheaders_dat.seek(start_row * 80)
+		data = blockheaders_dat.read(max_count * 80)
+
+	# drop a header still being appended by sync
+	return data[: len(data) - len(data) % 80]
+
+
+def get_block_header_count():
+	# number of whole headers in the headers file
+	return os.stat(BLOCK_HEADERS_FILENAME).st_size / 80
+
+
+def get_block_header_hash(row):
+	# header hash of the nth header of the headers file, or None if past the end
+	header_bin = get_block_headers(row, 1)
+	if len(header_bin) != 80:
+		return None
+
+	return hashlib.sha256(hashlib.sha256(header_bin).digest()).digest()
+
+
+def get_locator_rows(row_count):
+	# rows of a block locator over the first row_count headers of a headers file, last row first
+	# the last 10 rows one by one, then twice as far apart each time, and the first row
+	rows = []
+	step = 1
+	row = row_count - 1
+
+	while row > 0:
+		rows += [row]
+		if len(rows) >= 10:
+			step *= 2
+		row -= step
+
+	if row_count > 0:
+		rows += [0]
+
+	return rows
+
+
+def setup(directory_path, num_processes=1):
+	global block_count
+	global blockchain_directory
+	global indexed_checkpoint
+
 	#print("Do not start SPV clients yet..")
 
-	# load all blocks
+	# resume from the indexes of a previous run instead of parsing every block again
+	index_filenames = [TX_INDEX_FILENAME, BLOCK_INDEX_FILENAME, BLOCK_HEADERS_FILENAME, CHECKPOINT_FILENAME]
+	warm_start = all(os.path.isfile(index_filename) for index_filename in index_filenames)
+
+	# filters turned on since the last run have to be built for every block
+	if warm_start and BUILD_BLOCK_FILTERS and not has_block_filters():
+		print("Block filters are not built yet, parse every block again...")
+		warm_start = False
+
+	# same for the script index
+	if warm_start and BUILD_SCRIPT_INDEX and not has_script_index():
+		print("Script index is not built yet, parse every block again...")
+		warm_start = False
+
+	if warm_start:
+		# blocks synced after the indexes were last flushed are parsed again,
+		# drop their headers and filters so they are not appended twice
+		indexed_checkpoint = load_indexed_checkpoint()
+		nth_file, header_start, header_count, filters_size = indexed_checkpoint
+		truncate_file(BLOCK_HEADERS_FILENAME, header_count * 80)
+		if BUILD_BLOCK_FILTERS:
+			truncate_file(block_filter.FILTERS_FILENAME, filters_size)
+		save_checkpoint(nth_file, header_start)
+
+		print("Open indexes...")
+		tx_index.index.open(TX_INDEX_FILENAME)
+		block_index.index.open(BLOCK_INDEX_FILENAME)
+		if BUILD_SCRIPT_INDEX:
+			script_index.index.open(SCRIPT_INDEX_FILENAME)
+		if BUILD_BLOCK_FILTERS:
+			block_filter.index_filters()
+
+		block_count = get_block_header_count()
+		blockchain_directory = directory_path
+
+		# parse only blocks appended since the last run
+		print("Sync blockchain files...")
+		sync_blockchain(directory_path)
+		return
+
+	# load all blocks, a transaction index of a previous run is merged with the new one
 	print("Load blockchain files...")
-	load_blockchain(directory_path)
+	load_blockchain(directory_path, num_processes)
 
 	#print("Block headers are now ready to be fetched by SPV clients.")
 	#print("Please run SPV clients...")
 	return
 
 
+def get_block_location(block_hash):
+	# nth_file, block_start, block_size of a block
+	if block_hash in block_hash_to_location:
+		return block_hash_to_location[block_hash]
+
+	# None if full node cant find this block
+	return block_index.lookup(block_hash)
+
+
+def read_block(block_hash):
+	# raw block, header and transactions, read back from its .dat file, or None
+	block_location = get_block_location(block_hash)
+	if block_location is None:
+		return None
+
+	nth_file, block_start, block_size = block_location
+
+	# read just this block
+	with open(get_filename(blockchain_directory, nth_file), "rb") as blockchain_dat:
+		blockchain_dat.seek(block_start)
+		block_data = blockchain_dat.read(block_size)
+
+	# file was pruned or rewritten by the node
+	if len(block_data) != block_size:
+		return None
+
+	return block_data
+
+
+def read_block_tx_hashes(block_hash):
+	# packed transaction hashes of a block, read back from its .dat file
+	block_data = read_block(block_hash)
+	if block_data is None:
+		return None
+
+	return get_block_tx_hashes(block_data, 0)
+
+
+def get_cached_merkle_tree(block_hash):
+	# tx_count, merkle tree of a block, or None if full node cant find this block
+	# the cache holds the leaves of recently used blocks, so it doubles as their txid arrays
+
+	# check recently used blocks first
+	with merkle_tree_cache_lock:
+		if block_hash in merkle_tree_cache:
+			# move to most recently used
+			cached = merkle_tree_cache.pop(block_hash)
+			merkle_tree_cache[block_hash] = cached
+			return cached
+
+	# read the block's leaves back from disk and recompute merkle tree outside the lock
+	leaf_hashes = read_block_tx_hashes(block_hash)
+	if leaf_hashes is None:
+		return None
+
+	merkle_tree = get_merkle_tree(leaf_hashes)
+	cached = (len(leaf_hashes) / 32, merkle_tree)
+
+	with merkle_tree_cache_lock:
+		merkle_tree_cache[block_hash] = cached
+
+		# evict least recently used
+		while len(merkle_tree_cache) > MERKLE_TREE_CACHE_SIZE:
+			merkle_tree_cache.popitem(last=False)
+
+	return cached
+
+
 def get_merkle_branches(merkle_tree, tx_leaf_index):
+	# merkle tree of all transactions in a block
+
 	# the block only has one transaction, so txid is merkle root
 	# no merkle branch for this transaction
 	if len(merkle_tree) == 1:
@@ -606,52 +1332,95 @@ def get_merkle_branches(merkle_tree, tx_leaf_index):
 	merkle_branches = []
 
 	# index of the computed hash
-	tx_index = tx_leaf_index
+	tx_level_index = tx_leaf_index
 
 	# bottom-up traversal for each padded merkle tree level
 	for i in range(0, len(merkle_tree) - 1):
 		merkle_level = merkle_tree[i]
-		merkle_branch = ""
+		merkle_branch = b""
 
 		# find the neighbor hashing pair of this transaction
-		if tx_index % 2 == 0:
+		if tx_level_index % 2 == 0:
 			# right neighbor is the merkle branch
-			merkle_branch = merkle_level[tx_index + 1]
+			merkle_branch = get_merkle_node(merkle_level, tx_level_index + 1)
 		else:
-			# right neighbor is the merkle branch
-			merkle_branch = merkle_level[tx_index - 1]
+			# left neighbor is the merkle branch
+			merkle_branch = get_merkle_node(merkle_level, tx_level_index - 1)
 
 		# collect merkle branch
 		merkle_branches += [merkle_branch]
 		# next level index
-		tx_index = tx_index / 2
+		tx_level_index = tx_level_index / 2
 
 	return merkle_branches
 
 
-def get_transaction_merkle_tree(txid):
-	# convert to little endian
-	tx_hash = txid.decode('hex')[::-1].encode('hex_codec')
+def get_transaction_location(tx_hash):
+	# get block header hash of the block
+	# get transaction leaf index in merkle tree
+	if tx_hash in tx_hash_to_block_hash:
+		return tx_hash_to_block_hash[tx_hash]
+
+	# None if full node cant find this transaction
+	return tx_index.lookup(tx_hash)
+
+
+def get_script_index_records(key):
+	# (block_hash, tx_hash, tx_index, io_index) of a script index key, on disk and in memory
+	records = script_index.lookup(key)
+	for record in list(script_key_to_records.get(key, [])):
+		records += [script_index.unpack_record(record)]
+
+	return records
+
+
+def get_script_transactions(script, max_count=None):
+	# hashes of transactions paying to an output script and of transactions spending those outputs
+	# None if there are more than max_count of them, counted from the index records alone
+	output_records = get_script_index_records(script_index.get_script_key(script))
+	if max_count is not None and len(output_records) > max_count:
+		return None
+
+	tx_hashes = set()
+
+	for block_hash, tx_hash, tx_leaf_index, output_index in output_records:
+		tx_hashes.add(tx_hash)
+
+		# transactions spending this output
+		outpoint = tx_hash + struct.pack("<I", output_index)
+		for block_hash, spending_tx_hash, tx_leaf_index, input_index in get_script_index_records(
+				script_index.get_outpoint_key(outpoint)):
+			tx_hashes.add(spending_tx_hash)
+
+		if max_count is not None and len(tx_hashes) > max_count:
+			return None
+
+	return sorted(tx_hashes)
+
+
+def get_transaction_merkle_tree(tx_hash):
+	# tx_hash is the raw little endian transaction hash
+	# branches and merkle root are returned as raw little endian hashes
+
+	tx_location = get_transaction_location(tx_hash)
 
 	# full node cant find this transaction
-	if tx_hash not in tx_hash_to_block_hash:
-		return 0, 0, [], ""
+	if tx_location is None:
+		return 0, 0, [], b""
 
-	# get block header hash of the block
-	# get transaction leaf index in merkle tree
-	block_hash, tx_leaf_index = tx_hash_to_block_hash[tx_hash]
+	block_hash, tx_leaf_index = tx_location
 
-	# get block
-	block = block_hash_to_block[block_hash]
+	# number of transactions and merkle tree of this block
+	cached = get_cached_merkle_tree(block_hash)
 
-	# number of transactions in this block
-	tx_count = block.get_tx_count_int()
+	# block is gone from the node's files
+	if cached is None:
+		return 0, 0, [], b""
 
-	# merkle root hash in this block
-	tx_root_hash = block.get_merk_hash_little()
+	tx_count, merkle_tree = cached
 
-	# merkle tree of all transactions in this block
-	merkle_tree = block.get_merkle_tree()
+	# merkle root hash in this block
+	tx_root_hash = merkle_tree[-1]
 
 	# get the bottom-up merkle branches for this tansaction
 	tx_branch_hashes = get_merkle_branches(merkle_tree, tx_leaf_index)
@@ -659,4 +1428,91 @@ def get_transaction_merkle_tree(txid):
 	return tx_count, tx_leaf_index, tx_branch_hashes, tx_root_hash
 
 
+def get_merkle_level_width(tx_count, height):
+	# number of hashes in a merkle tree level, without padding
+	return (tx_count + (1 << height) - 1) >> height
+
+
+def traverse_partial_merkle_tree(merkle_tree, tx_count, height, pos, matches, partial_hashes, flag_bits):
+	# check if any matched transaction is below this node
+	# matches is the sorted list of matched leaf indexes
+	first_match = bisect.bisect_left(matches, pos << height)
+	parent_of_match = first_match < len(matches) and matches[first_match] < ((pos + 1) << height)
+
+	flag_bits += [parent_of_match]
+
+	if height == 0 or not parent_of_match:
+		# node hash stands in for the whole subtree
+		# the padded merkle tree levels give the hash of any node directly
+		partial_hashes += [get_merkle_node(merkle_tree[height], pos)]
+	else:
+		# descend into left child
+		traverse_partial_merkle_tree(merkle_tree, tx_count, height - 1, pos * 2,
+									matches, partial_hashes, flag_bits)
+
+		# descend into right child, unless it is only padding
+		if pos * 2 + 1 < get_merkle_level_width(tx_count, height - 1):
+			traverse_partial_merkle_tree(merkle_tree, tx_count, height - 1, pos * 2 + 1,
+										matches, partial_hashes, flag_bits)
+
+	return
+
+
+def get_partial_merkle_tree(merkle_tree, tx_count, tx_leaf_indexes):
+	# BIP37 partial merkle tree covering every matched transaction of a block
+	# https://bitcoin.org/en/developer-reference#parsing-a-merkleblock-message
+
+	# depth-first traversal hashes and flag bits
+	partial_hashes = []
+	flag_bits = []
+
+	# traverse from the merkle root
+	traverse_partial_merkle_tree(merkle_tree, tx_count, len(merkle_tree) - 1, 0,
+								sorted(set(tx_leaf_indexes)), partial_hashes, flag_bits)
+
+	# pack flag bits least significant bit first
+	flag_bytes = bytearray((len(flag_bits) + 7) / 8)
+	for i in range(0, len(flag_bits)):
+		if flag_bits[i]:
+			flag_bytes[i / 8] |= 1 << (i % 8)
+
+	return partial_hashes, bytes(flag_bytes)
+
+
+def get_transactions_merkle_proofs(tx_hashes):
+	# tx_hashes are raw little endian transaction hashes
+	# proofs are grouped per block so transactions in one block share branch nodes
+
+	# block_hash -> leaf indexes of requested transactions, in first seen order
+	block_hash_to_leaf_indexes = collections.OrderedDict()
+	# block_hash -> requested transactions, to report if the block cant be read
+	block_hash_to_tx_hashes = {}
+	# transactions the full node cant find
+	missing_tx_hashes = []
+
+	for tx_hash in tx_hashes:
+		tx_location = get_transaction_location(tx_hash)
+		if tx_location is None:
+			missing_tx_hashes += [tx_hash]
+			continue
+
+		block_hash, tx_leaf_index = tx_location
+		block_hash_to_leaf_indexes.setdefault(block_hash, []).append(tx_leaf_index)
+		block_hash_to_tx_hashes.setdefault(block_hash, []).append(tx_hash)
+
+	# (tx_count, tx_root_hash, partial_hashes, flag_bytes) for each block
+	proofs = []
+	for block_hash, tx_leaf_indexes in block_hash_to_leaf_indexes.items():
+		cached = get_cached_merkle_tree(block_hash)
+
+		# block is gone from the node's files
+		if cached is None:
+			missing_tx_hashes += block_hash_to_tx_hashes[block_hash]
+			continue
+
+		tx_count, merkle_tree = cached
+
+		partial_hashes, flag_bytes = get_partial_merkle_tree(merkle_tree, tx_count, tx_leaf_indexes)
+		proofs += [(tx_count, merkle_tree[-1], partial_hashes, flag_bytes)]
 
+	return proofs, missing_tx_hashes
@@ -5,20 +5,109 @@
 
 # https://docs.python.org/3/library/http.server.html
 
+import os
 import io
 import random
 import string
 import json
 import time
 import socket
+import select
+import struct
+import hashlib
 import threading
-from SocketServer import ThreadingMixIn
+import multiprocessing
+import signal
+import Queue
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
-from urlparse import urlparse
+from SocketServer import StreamRequestHandler
+from urlparse import urlparse, parse_qs
 import blockchain
+import block_filter
+
+
+# largest number of txids accepted in one batch request
+MAX_BATCH_TXIDS = 100000
+
+# number of worker threads serving requests concurrently
+NUM_WORKERS = 32
+
+# seconds a keep-alive connection may stay idle between requests before it is closed
+KEEP_ALIVE_TIMEOUT = 15
+
+# seconds a client may stall in the middle of a request while it holds a worker
+REQUEST_TIMEOUT = 15
+
+# largest number of block headers returned in one response
+MAX_HEADERS_PER_REQUEST = 2000
+
+# largest number of block filters returned in one response
+MAX_FILTERS_PER_REQUEST = 1000
+
+# largest number of txids one subscription may watch
+MAX_SUBSCRIPTION_TXIDS = 1000
+
+# seconds a push to a subscriber may block before the subscriber is dropped
+SUBSCRIBER_SEND_TIMEOUT = 2
+
+
+def parse_txid(hash_big_endian):
+	# raw little endian hash of a big endian hex txid, or None if malformed
+	# check if string length is 64
+	if len(hash_big_endian) != 64:
+		return None
+
+	# check if it is proper hex string
+	# int() would also take a sign, a 0x prefix or spaces, which decode('hex') rejects
+	if not all(c in string.hexdigits for c in hash_big_endian):
+		return None
+
+	return hash_big_endian.decode('hex')[::-1]
+
+
+def get_merkle_branches_message(tx_hash):
+	# get transaction merkle branches
+	tx_count, tx_leaf_index, tx_branch_hashes, tx_root_hash  = \
+		blockchain.get_transaction_merkle_tree(tx_hash)
+
+	# hashes go over the wire as little endian hex strings
+	return {	"tx_count": tx_count,
+				"tx_leaf_index": tx_leaf_index,
+				"tx_branch_hashes": [branch.encode('hex_codec') for branch in tx_branch_hashes],
+				"tx_root_hash": tx_root_hash.encode('hex_codec')}
 
 
 class Handler(BaseHTTPRequestHandler):
+	# keep connections open across requests
+	protocol_version = "HTTP/1.1"
+
+	# release the worker from a client that stalls in the middle of a request
+	timeout = REQUEST_TIMEOUT
+
+	# buffer response writes, they are flushed once per request
+	wbufsize = -1
+	disable_nagle_algorithm = True
+
+	# set once the socket is handed over to the subscribers, the worker must leave it open
+	subscribed = False
+
+	def handle(self):
+		# serve one request, the server waits for the next one without holding a worker
+		self.close_connection = 1
+		self.handle_one_request()
+
+	def finish(self):
+		# connection stays open for the next request, close_files ends it
+		return
+
+	def close_files(self):
+		# flush and close the buffered socket files
+		StreamRequestHandler.finish(self)
+
+	def has_buffered_request(self):
+		# a pipelined request already read into the buffer, select never reports it
+		return len(self.rfile._rbuf.getvalue()) > 0
+
 	# handle http GET requests
 	def do_GET(self):
 		print("GET: " + self.path)
@@ -28,44 +117,562 @@ class Handler(BaseHTTPRequestHandler):
 
 		# check if endpoint correct
 		endpoint = parsed_path.path
-		if endpoint != "/txid":
+		if endpoint == "/txid":
+			self.get_txid(parsed_path)
+		elif endpoint == "/headers":
+			self.get_headers(parsed_path)
+		elif endpoint == "/script":
+			self.get_script(parsed_path)
+		elif endpoint == "/filters":
+			self.get_filters(parsed_path)
+		elif endpoint == "/block":
+			self.get_block(parsed_path)
+		elif endpoint == "/subscribe":
+			self.subscribe(parsed_path)
+		else:
+			self.send_error(404)
+
+		return
+
+	# respond merkle branches of a transaction
+	def get_txid(self, parsed_path):
+		# parse query
+		# convert to raw little endian hash
+		tx_hash = parse_txid(parsed_path.query)
+		if tx_hash is None:
+			self.send_error(400)
+			return
+
+		message = json.dumps(get_merkle_branches_message(tx_hash))
+
+		body = message.encode('utf-8') + b'\n'
+
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; charset=utf-8")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+
+		self.wfile.write(body)
+
+	# respond a batch of raw block headers past the ones a client already has
+	def get_headers(self, parsed_path):
+		# parse query
+		# start: number of headers the client already has
+		# locator: little endian hex hashes of the client's headers at blockchain.get_locator_rows(start)
+		query = parse_qs(parsed_path.query)
+		try:
+			start_row = int(query["start"][0])
+			locator = query.get("locator", [""])[0].decode('hex')
+		except (KeyError, ValueError, TypeError):
+			self.send_error(400)
+			return
+
+		locator_rows = blockchain.get_locator_rows(start_row) if start_row >= 0 else None
+		if locator_rows is None or len(locator) != len(locator_rows) * 32:
+			self.send_error(400)
+			return
+
+		# last row the client shares with the headers file, it differs past it if the file was rebuilt
+		# the client replaces its headers past that row and keeps every header it already parsed
+		shared_row = -1
+		for i in xrange(0, len(locator_rows)):
+			if blockchain.get_block_header_hash(locator_rows[i]) == locator[i * 32: (i + 1) * 32]:
+				shared_row = locator_rows[i]
+				break
+
+		# first row (4 bytes little endian) | concatenated 80 byte headers from that row,
+		# no headers when the client is up to date
+		body = struct.pack("<I", shared_row + 1) + blockchain.get_block_headers(shared_row + 1,
+																				MAX_HEADERS_PER_REQUEST)
+
+		self.send_response(200)
+		self.send_header("Content-Type", "application/octet-stream")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+
+		self.wfile.write(body)
+
+	# respond merkle proofs of every transaction paying to or spending from an output script
+	def get_script(self, parsed_path):
+		# script index is not built
+		if not blockchain.BUILD_SCRIPT_INDEX:
+			self.send_error(404)
+			return
+
+		# parse query
+		# hex output script
+		try:
+			script = parsed_path.query.decode('hex')
+		except TypeError:
+			self.send_error(400)
+			return
+
+		if len(script) == 0:
+			self.send_error(400)
+			return
+
+		# stops counting once the result is too large
+		tx_hashes = blockchain.get_script_transactions(script, MAX_BATCH_TXIDS)
+
+		# check if result is too large
+		if tx_hashes is None:
+			self.send_error(413)
+			return
+
+		self.send_response(200)
+		self.send_header("Content-Type", "application/octet-stream")
+		self.send_header("Transfer-Encoding", "chunked")
+		self.end_headers()
+
+		# response body is the txid count (4 bytes little endian) and txids (32 bytes each),
+		# followed by their merkle proofs in the format of POST /txids
+		self.write_chunk(struct.pack("<I", len(tx_hashes)) + b"".join(tx_hashes))
+		if len(tx_hashes) > 0:
+			self.write_merkle_proofs(tx_hashes)
+		else:
+			self.write_chunk(struct.pack("<II", 0, 0))
+
+		# last chunk
+		self.write_chunk(b"")
+
+	# respond a batch of block filters, in the order of the block headers file
+	def get_filters(self, parsed_path):
+		# block filters are not built
+		if not blockchain.BUILD_BLOCK_FILTERS:
+			self.send_error(404)
+			return
+
+		# parse query
+		# start: number of block filters the client already has
+		query = parse_qs(parsed_path.query)
+		try:
+			start_row = int(query["start"][0])
+		except (KeyError, ValueError):
+			self.send_error(400)
+			return
+
+		if start_row < 0:
+			self.send_error(400)
+			return
+
+		# block hash | filter size (var int) | filter, for every block
+		# empty when the client is up to date
+		body = block_filter.get_filter_records(start_row, MAX_FILTERS_PER_REQUEST)
+
+		self.send_response(200)
+		self.send_header("Content-Type", "application/octet-stream")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+
+		self.wfile.write(body)
+
+	# respond a raw block a block filter matched, so a wallet can find its transactions in it
+	def get_block(self, parsed_path):
+		# block filters are not built, no wallet has a reason to download blocks
+		if not blockchain.BUILD_BLOCK_FILTERS:
+			self.send_error(404)
+			return
+
+		# parse query
+		# big endian hex block hash, same format as a txid
+		block_hash = parse_txid(parsed_path.query)
+		if block_hash is None:
+			self.send_error(400)
+			return
+
+		# header | transaction count (var int) | transactions
+		body = blockchain.read_block(block_hash)
+		if body is None:
 			self.send_error(404)
 			return
 
+		self.send_response(200)
+		self.send_header("Content-Type", "application/octet-stream")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+
+		self.wfile.write(body)
+
+	# keep the connection open to push merkle branches of txids once mined and new headers
+	def subscribe(self, parsed_path):
 		# parse query
-		hash_big_endian = parsed_path.query
+		# txid: big endian hex txid to watch, may repeat
+		# tip: 1 to be notified of every new block header
+		query = parse_qs(parsed_path.query)
+		tx_hashes = set()
+		for hash_big_endian in query.get("txid", []):
+			tx_hash = parse_txid(hash_big_endian)
+			if tx_hash is None:
+				self.send_error(400)
+				return
+			tx_hashes.add(tx_hash)
+
+		watch_tip = query.get("tip", ["0"])[0] == "1"
 
-		# check if string length is 64
-		if len(hash_big_endian) != 64:
+		# check if subscription watches anything
+		if len(tx_hashes) == 0 and not watch_tip:
 			self.send_error(400)
 			return
 
-		# check if it is proper hex string
+		# check if subscription is too large
+		if len(tx_hashes) > MAX_SUBSCRIPTION_TXIDS:
+			self.send_error(413)
+			return
+
+		# server-sent events until every txid is mined, or until the client leaves when watching headers
+		self.send_response(200)
+		self.send_header("Content-Type", "text/event-stream")
+		self.send_header("Cache-Control", "no-cache")
+		self.send_header("Connection", "close")
+		self.end_headers()
+		self.wfile.flush()
+
+		# hand the socket over to the sync thread, this worker is free for other connections
+		self.close_connection = 1
+		self.subscribed = True
+		add_subscriber(self.request, tx_hashes, watch_tip)
+
+	def write_chunk(self, data):
+		# chunked transfer encoding lets the response stream on a keep-alive connection
+		self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+
+	# handle http POST requests
+	def do_POST(self):
+		print("POST: " + self.path)
+
+		# parse url path
+		parsed_path = urlparse(self.path)
+
+		# check if endpoint correct
+		endpoint = parsed_path.path
+		if endpoint != "/txids":
+			self.send_error(404)
+			return
+
+		# request body is concatenated raw little endian txids, 32 bytes each
 		try:
-			int(hash_big_endian, 16)
+			content_length = int(self.headers.getheader("Content-Length", 0))
 		except ValueError:
 			self.send_error(400)
 			return
 
-		# get transaction merkle branches
-		tx_count, tx_leaf_index, tx_branch_hashes, tx_root_hash  = \
-			blockchain.get_transaction_merkle_tree(hash_big_endian)
+		# check if body holds whole txids
+		if content_length == 0 or content_length % 32 != 0:
+			self.send_error(400)
+			return
+
+		# check if batch is too large
+		if content_length / 32 > MAX_BATCH_TXIDS:
+			self.send_error(413)
+			return
+
+		body = self.rfile.read(content_length)
+		if len(body) != content_length:
+			self.send_error(400)
+			return
 
-		message = json.dumps({	"tx_count": tx_count,
-								"tx_leaf_index": tx_leaf_index,
-								"tx_branch_hashes": tx_branch_hashes,
-								"tx_root_hash": tx_root_hash})
+		tx_hashes = [body[i: i + 32] for i in range(0, content_length, 32)]
 
 		self.send_response(200)
-		self.send_header("Content-Type", "text/plain; charset=utf-8")
+		self.send_header("Content-Type", "application/octet-stream")
+		self.send_header("Transfer-Encoding", "chunked")
 		self.end_headers()
 
-		self.wfile.write(message.encode('utf-8'))
-		self.wfile.write(b'\n')
+		self.write_merkle_proofs(tx_hashes)
+
+		# last chunk
+		self.write_chunk(b"")
+
+	# stream merkle proofs of txids grouped by block
+	def write_merkle_proofs(self, tx_hashes):
+		# get merkle proofs grouped by block
+		proofs, missing_tx_hashes = blockchain.get_transactions_merkle_proofs(tx_hashes)
+
+		# response body, all integers little endian:
+		#   block count (4 bytes)
+		#   for each block, a BIP37 partial merkle tree of the requested txids in it:
+		#     merkle root (32 bytes) | total transactions (4 bytes) |
+		#     hash count (var int) | hashes (32 bytes each) |
+		#     flag byte count (var int) | flag bytes
+		#   missing txid count (4 bytes) | missing txids (32 bytes each)
+		self.write_chunk(struct.pack("<I", len(proofs)))
+
+		# stream each block proof as soon as it is serialized
+		for tx_count, tx_root_hash, partial_hashes, flag_bytes in proofs:
+			self.write_chunk(tx_root_hash + struct.pack("<I", tx_count) +
+							blockchain.to_var_len_int(len(partial_hashes)) + b"".join(partial_hashes) +
+							blockchain.to_var_len_int(len(flag_bytes)) + flag_bytes)
+
+		self.write_chunk(struct.pack("<I", len(missing_tx_hashes)) + b"".join(missing_tx_hashes))
+
+
+class WorkerPoolHTTPServer(HTTPServer):
+	# serve connections on a fixed pool of worker threads instead of a new thread per request
+	# workers only hold a connection while they serve a request on it, idle keep-alive
+	# connections wait in a poll loop until they are readable again
+
+	# pending connections the kernel queues while every worker is busy
+	request_queue_size = 1024
+
+	def __init__(self, server_address, RequestHandlerClass, num_workers):
+		HTTPServer.__init__(self, server_address, RequestHandlerClass)
+
+		# readable connections waiting for a worker, bounded so the poll loop backs off under load
+		# (request, client_address, handler or None before the first request)
+		self.connections = Queue.Queue(num_workers)
+
+		# connections handed to the poll loop, a byte on the wakeup pipe tells it to pick them up
+		self.idle_connections = []
+		self.idle_connections_lock = threading.Lock()
+		self.wakeup_read, self.wakeup_write = os.pipe()
+
+		# start poll thread
+		self.poll_thread = threading.Thread(target=self.poll_connections)
+		self.poll_thread.daemon = True
+		self.poll_thread.start()
+
+		# start worker threads
+		self.workers = []
+		for i in range(0, num_workers):
+			worker = threading.Thread(target=self.process_connections)
+			worker.daemon = True
+			worker.start()
+			self.workers += [worker]
+
+	def process_request(self, request, client_address):
+		# wait for the accepted connection to send its first request
+		self.add_idle_connection(request, client_address, None)
+
+	def add_idle_connection(self, request, client_address, handler):
+		# hand a connection to the poll loop, request None stops it
+		with self.idle_connections_lock:
+			self.idle_connections += [(request, client_address, handler)]
+		os.write(self.wakeup_write, b"x")
+
+	def poll_connections(self):
+		# file descriptor -> (request, client_address, handler, idle since)
+		idle = {}
+		poller = select.poll()
+		poller.register(self.wakeup_read, select.POLLIN)
+
+		while True:
+			for fd, event in poller.poll(1000):
+				if fd == self.wakeup_read:
+					os.read(self.wakeup_read, 4096)
+					continue
+
+				# next request, or the client has gone away, a worker finds out which
+				request, client_address, handler, idle_since = idle.pop(fd)
+				poller.unregister(fd)
+				self.connections.put((request, client_address, handler))
+
+			# pick up connections handed back by workers and newly accepted ones
+			with self.idle_connections_lock:
+				idle_connections = self.idle_connections
+				self.idle_connections = []
+
+			for request, client_address, handler in idle_connections:
+				# server is closing
+				if request is None:
+					for fd in idle.keys():
+						request, client_address, handler, idle_since = idle.pop(fd)
+						self.close_connection(request, handler)
+					return
+
+				idle[request.fileno()] = (request, client_address, handler, time.time())
+				poller.register(request, select.POLLIN)
 
+			# close connections idle for too long
+			now = time.time()
+			for fd in idle.keys():
+				request, client_address, handler, idle_since = idle[fd]
+				if now - idle_since > KEEP_ALIVE_TIMEOUT:
+					del idle[fd]
+					poller.unregister(fd)
+					self.close_connection(request, handler)
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-	pass
+	def close_connection(self, request, handler):
+		if handler is not None:
+			try:
+				handler.close_files()
+			except socket.error:
+				pass
+		self.shutdown_request(request)
+
+	def process_connections(self):
+		while True:
+			request, client_address, handler = self.connections.get()
+
+			# server is closing
+			if request is None:
+				break
+
+			# serve the requests this connection has sent, then hand it back to the poll loop
+			# subscriptions keep their connection open after the worker is done
+			try:
+				if handler is None:
+					handler = self.RequestHandlerClass(request, client_address, self)
+				else:
+					handler.handle()
+
+				while not handler.close_connection and handler.has_buffered_request():
+					handler.handle()
+			except socket.error:
+				# client has gone away
+				if handler is not None:
+					handler.close_connection = 1
+			except Exception:
+				self.handle_error(request, client_address)
+				if handler is not None:
+					handler.close_connection = 1
+
+			if handler is not None and handler.subscribed:
+				continue
+
+			if handler is None or handler.close_connection:
+				self.close_connection(request, handler)
+			else:
+				self.add_idle_connection(request, client_address, handler)
+
+	def server_close(self):
+		HTTPServer.server_close(self)
+
+		# close idle connections and stop the poll loop
+		self.add_idle_connection(None, None, None)
+		self.poll_thread.join()
+
+		# let workers finish queued connections, then stop them
+		for worker in self.workers:
+			self.connections.put((None, None, None))
+		for worker in self.workers:
+			worker.join()
+
+		# end every subscription
+		close_subscribers()
+
+
+# subscribed socket -> (raw little endian txids not mined yet, whether new headers are pushed)
+# the lock only guards the dict, proofs and pushes run outside it
+subscribers = {}
+subscribers_lock = threading.Lock()
+
+
+def write_event(connection, event, data):
+	# server-sent event, False if the client has gone away
+	try:
+		connection.sendall(b"event: " + event + b"\ndata: " + json.dumps(data) + b"\n\n")
+	except socket.error:
+		return False
+
+	return True
+
+
+def push_mined_transactions(connection, tx_hashes):
+	# push merkle branches of every watched txid that is now in a block
+	for tx_hash in list(tx_hashes):
+		message = get_merkle_branches_message(tx_hash)
+		if message["tx_count"] == 0:
+			continue
+
+		message["txid"] = tx_hash[::-1].encode('hex_codec')
+		if not write_event(connection, b"proof", message):
+			return False
+
+		tx_hashes.remove(tx_hash)
+
+	return True
+
+
+def close_subscriber(connection):
+	# safe to call more than once, the sync thread and shutdown may both end a subscription
+	with subscribers_lock:
+		subscribers.pop(connection, None)
+
+	try:
+		connection.shutdown(socket.SHUT_RDWR)
+	except socket.error:
+		pass
+	connection.close()
+
+
+def add_subscriber(connection, tx_hashes, watch_tip):
+	# a slow client fails its pushes after a short wait instead of holding the sync thread
+	connection.settimeout(SUBSCRIBER_SEND_TIMEOUT)
+
+	# txids mined before the subscription are pushed at once
+	if not push_mined_transactions(connection, tx_hashes) or (len(tx_hashes) == 0 and not watch_tip):
+		close_subscriber(connection)
+		return
+
+	# keep watching
+	with subscribers_lock:
+		subscribers[connection] = (tx_hashes, watch_tip)
+
+	return
+
+
+def notify_subscribers(first_row, header_hashes):
+	# called after every sync, one pass over a snapshot of the subscriptions
+	# header_hashes are the headers the sync appended from the nth header on, empty if none
+	with subscribers_lock:
+		subscriptions = subscribers.items()
+
+	for connection, (tx_hashes, watch_tip) in subscriptions:
+		if watch_tip and len(header_hashes) > 0:
+			# one event per new header, fork headers included, the headers file does not end at the tip
+			# clients fetch the headers from /headers and follow the chain with the most work
+			for i in xrange(0, len(header_hashes)):
+				delivered = write_event(connection, b"header", {"header_count": first_row + i + 1,
+															"header_hash": header_hashes[i].encode('hex_codec')})
+				if not delivered:
+					break
+		else:
+			# comment line, detects clients that have gone away
+			try:
+				connection.sendall(b": keep-alive\n\n")
+				delivered = True
+			except socket.error:
+				delivered = False
+
+		if delivered:
+			delivered = push_mined_transactions(connection, tx_hashes)
+
+		# subscription is done or client has gone away
+		if not delivered or (len(tx_hashes) == 0 and not watch_tip):
+			close_subscriber(connection)
+
+	return
+
+
+def close_subscribers():
+	with subscribers_lock:
+		connections = subscribers.keys()
+
+	for connection in connections:
+		close_subscriber(connection)
+
+	return
+
+
+# seconds between incremental syncs of new blocks from the full node
+SYNC_INTERVAL = 60
+
+# set to stop the sync thread
+sync_stopping = threading.Event()
+
+
+def sync_blockchain_forever(directory_path):
+	# keep indexes and block headers current as the full node syncs, until asked to stop
+	while not sync_stopping.wait(SYNC_INTERVAL):
+		header_count = blockchain.get_block_header_count()
+		blockchain.sync_blockchain(directory_path)
+
+		# push every new header and newly mined txids to subscribers
+		new_headers = blockchain.get_block_headers(header_count, blockchain.get_block_header_count() - header_count)
+		header_hashes = [hashlib.sha256(hashlib.sha256(new_headers[i: i + 80]).digest()).digest()
+						for i in xrange(0, len(new_headers), 80)]
+
+		notify_subscribers(header_count, header_hashes)
 
 
 if __name__ == "__main__":
@@ -74,27 +681,47 @@ if __name__ == "__main__":
 
 	# pass the local raw blockchain directory to proxy to parse
 	print("Full node proxy is initializing...")
-	#blockchain.setup("Bitcoin/blocks/")
-	blockchain.setup("")
+	# parse blockchain files on every core
+	#blockchain.setup("Bitcoin/blocks/", multiprocessing.cpu_count())
+	blockchain.setup("", multiprocessing.cpu_count())
 	print("Set up done.")
 
 	HOST, PORT = "localhost", 9000
 	# create server
-	server = ThreadedHTTPServer((HOST, PORT), Handler)
-	# start server thread to handle http requests from spv clients
-	# server thread starts new thread for each new request
+	server = WorkerPoolHTTPServer((HOST, PORT), Handler, NUM_WORKERS)
+	# start server thread to accept http requests from spv clients
+	# accepted connections are served by the pool of worker threads
 	server_thread = threading.Thread(target=server.serve_forever)
 	server_thread.daemon = True
 	server_thread.start()
 	print("Ready to handle http requests from SPV clients...")
 
-	# hang to wait for connections
-	while True:
-		continue
+	# start sync thread to pick up new blocks from the full node
+	#sync_thread = threading.Thread(target=sync_blockchain_forever, args=("Bitcoin/blocks/",))
+	sync_thread = threading.Thread(target=sync_blockchain_forever, args=("",))
+	sync_thread.daemon = True
+	sync_thread.start()
 
-	# clean up server
+	# sleep until SIGINT or SIGTERM asks to shut down
+	shutdown_requested = threading.Event()
+	def request_shutdown(signum, frame):
+		shutdown_requested.set()
+	signal.signal(signal.SIGINT, request_shutdown)
+	signal.signal(signal.SIGTERM, request_shutdown)
+
+	while not shutdown_requested.is_set():
+		signal.pause()
+
+	# stop accepting, then drain in-flight requests and clean up server
+	print("Shutting down...")
 	server.shutdown()
 	server.server_close()
 
+	# let a running sync finish, then write the in-memory indexes to disk
+	# so the next start resumes from the last synced block
+	sync_stopping.set()
+	sync_thread.join()
+	blockchain.flush_indexes()
+
 
 
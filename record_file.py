@@ -0,0 +1,120 @@
+# record_file.py
+# Sorted files of fixed-width records, the on-disk format of the indexes
+#
+# HingOn Miu
+
+# A record file holds records of one size, sorted by the key its records start with.
+# It is built by writing sorted runs and merging them, and it is opened with mmap and
+# searched with binary search, so lookups take O(log n) time and only touch the pages
+# they need. Each index packs and unpacks its own records.
+
+import os
+import heapq
+import mmap
+
+
+# sorted fixed-width records of one index
+class RecordFile:
+
+	def __init__(self, record_size, key_size):
+		# bytes of each record, and of the key it starts with
+		self.record_size = record_size
+		self.key_size = key_size
+
+		# memory-mapped index file
+		self.data = None
+
+	def write_run(self, run_filename, records):
+		# write a run of packed records, already sorted by key
+		with open(run_filename, "wb") as run_file:
+			for record in records:
+				run_file.write(record)
+
+		return
+
+	def read_run(self, run_filename, nth_run):
+		# stream records of a sorted run, tagged with the run number so later runs sort last
+		with open(run_filename, "rb") as run_file:
+			while True:
+				record = run_file.read(self.record_size)
+				if len(record) < self.record_size:
+					break
+
+				yield record[:self.key_size], nth_run, record
+
+		return
+
+	def merge_runs(self, run_filenames, index_filename):
+		# k-way merge of sorted runs, only one record per run is held in memory
+		runs = [self.read_run(run_filenames[i], i) for i in range(0, len(run_filenames))]
+
+		with open(index_filename, "wb") as index_file:
+			last_key = None
+			last_record = None
+
+			for key, nth_run, record in heapq.merge(*runs):
+				# a key seen in a later run replaces the earlier one
+				if key != last_key and last_record is not None:
+					index_file.write(last_record)
+
+				last_key = key
+				last_record = record
+
+			if last_record is not None:
+				index_file.write(last_record)
+
+		# clean up runs
+		for run_filename in run_filenames:
+			os.remove(run_filename)
+
+		return
+
+	def open(self, index_filename):
+		# an empty index has nothing to map
+		if os.stat(index_filename).st_size == 0:
+			self.data = None
+			return
+
+		# replace the mapping without closing the old one,
+		# so lookups still running on it finish before it is freed
+		with open(index_filename, "rb") as index_file:
+			self.data = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		return
+
+	def close(self):
+		if self.data is not None:
+			self.data.close()
+
+		self.data = None
+		return
+
+	def find_first(self, data, key):
+		# binary search the first record of data starting with key or above it
+		low = 0
+		high = len(data) / self.record_size
+
+		while low < high:
+			mid = (low + high) / 2
+			record_start = mid * self.record_size
+
+			if data[record_start: record_start + len(key)] < key:
+				low = mid + 1
+			else:
+				high = mid
+
+		return low
+
+	def lookup(self, key):
+		# take one reference in case the index is reopened during the search
+		data = self.data
+		if data is None:
+			return None
+
+		# raw record of the key
+		record_start = self.find_first(data, key) * self.record_size
+		record = data[record_start: record_start + self.record_size]
+		if record[:self.key_size] != key:
+			return None
+
+		return record
@@ -0,0 +1,71 @@
+# script_index.py
+# Persistent on-disk index of output scripts and spent outpoints to transactions
+#
+# HingOn Miu
+
+# The index is a record file (see record_file.py) of fixed-width records sorted by key:
+#   key (32 bytes) | block_hash (32 bytes little endian) | tx_hash (32 bytes little endian) |
+#   tx_index (4 bytes little endian) | io_index (4 bytes little endian)
+# There are two kinds of keys:
+#   SHA256(output script), io_index is the index of the output paying to the script
+#   SHA256(spent outpoint), io_index is the index of the input spending the outpoint
+# A key may have many records, so lookups binary search the first one and read on.
+# tx_hash is stored so a lookup gives txids without reading blocks back.
+
+import struct
+import hashlib
+import record_file
+
+
+# bytes of each record
+RECORD_SIZE = 32 + 32 + 32 + 4 + 4
+
+# on-disk records, merged by the whole record so the records of a block parsed again
+# are kept once, and looked up by the 32-byte key they start with
+index = record_file.RecordFile(RECORD_SIZE, RECORD_SIZE)
+
+
+def get_script_key(script):
+	# key of an output script
+	return hashlib.sha256(script).digest()
+
+
+def get_outpoint_key(outpoint):
+	# key of a spent outpoint, txid (32 bytes little endian) | output index (4 bytes little endian)
+	return hashlib.sha256(outpoint).digest()
+
+
+def pack_record(key, block_hash, tx_hash, tx_index, io_index):
+	# key | block_hash | tx_hash | tx_index | io_index
+	return key + block_hash + tx_hash + struct.pack("<II", tx_index, io_index)
+
+
+def unpack_record(record):
+	# block_hash, tx_hash, tx_index, io_index
+	tx_index, io_index = struct.unpack("<II", record[96:104])
+	return record[32:64], record[64:96], tx_index, io_index
+
+
+def pack_records(key_to_records):
+	# sorted records of an in-memory index
+	for key in sorted(key_to_records):
+		for record in sorted(key_to_records[key]):
+			yield record
+
+	return
+
+
+def lookup(key):
+	# take one reference in case the index is reopened during the search
+	data = index.data
+	if data is None:
+		return []
+
+	# read every record of the key, from the first one on
+	records = []
+	record_start = index.find_first(data, key) * RECORD_SIZE
+	while record_start < len(data) and data[record_start: record_start + 32] == key:
+		records += [unpack_record(data[record_start: record_start + RECORD_SIZE])]
+		record_start += RECORD_SIZE
+
+	return records
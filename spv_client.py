@@ -5,47 +5,415 @@
 
 
 import io
+import sys
 import random
 import string
 import json
 import time
+import struct
+import hashlib
 import requests
 import urllib
+import os
+import threading
+from multiprocessing.pool import ThreadPool
 import block_header
+import block_filter
+import blockchain
+import script_index
+
+
+# full node proxy serving merkle branches and block headers
+FULL_NODE_PROXY_URL = "http://127.0.0.1:9000"
+
+# local copy of the proxy's block headers file
+BLOCK_HEADERS_FILENAME = "blockheaders.dat"
+
+# seconds between block header syncs
+HEADER_SYNC_INTERVAL = 60
+
+# txids sent to full node proxy in one batch request
+BULK_BATCH_SIZE = 1000
+
+# batch requests in flight at once in bulk mode
+BULK_CONCURRENCY = 4
+
+# keep-alive session of each bulk request thread
+thread_data = threading.local()
+
+
+def sync_headers(session):
+	# download only the headers past the local headers file and link them into the chain
+	headers_start = block_header.headers_consumed
+	tip_start = block_header.latest_block_little
+	while True:
+		# local headers file mirrors the proxy's, the locator finds the last row both still share
+		start_row = block_header.headers_consumed / 80
+		locator = b"".join([block_header.get_last_header_hash(BLOCK_HEADERS_FILENAME, (row + 1) * 80)
+							for row in blockchain.get_locator_rows(start_row)])
+
+		response = session.get(FULL_NODE_PROXY_URL + "/headers",
+							params={"start": start_row, "locator": locator.encode('hex_codec')})
+
+		# check status code
+		if response.status_code != 200 or len(response.content) < 4:
+			print("  Cannot reach full node proxy.")
+			return False
+
+		# first row | concatenated 80 byte headers
+		first_row = struct.unpack_from("<I", response.content, 0)[0]
+		headers = response.content[4:]
+		if first_row > start_row:
+			print("  Cannot reach full node proxy.")
+			return False
+
+		# proxy rebuilt its headers file past the shared row, its headers replace the local ones from there
+		# headers already parsed stay in the chain index, the new ones are parsed and a fork among them
+		# is settled by chain work
+		if first_row < start_row:
+			print("  Block headers changed on full node proxy, sync from header " + str(first_row) + "..")
+			block_header.headers_consumed = first_row * 80
+			headers_start = None
+
+		# write the batch, then parse only the new headers
+		with open(BLOCK_HEADERS_FILENAME, "ab") as blockheaders_dat:
+			blockheaders_dat.seek(block_header.headers_consumed)
+			blockheaders_dat.truncate()
+			blockheaders_dat.write(headers)
+
+		block_header.load_new_headers(BLOCK_HEADERS_FILENAME)
+
+		if len(headers) == 0:
+			break
+
+	# headers that were ahead of the local clock are checked again, even without new headers
+	if len(block_header.pending_rows) > 0:
+		block_header.load_new_headers(BLOCK_HEADERS_FILENAME)
+
+	# persist the chain index for the next start
+	if block_header.headers_consumed != headers_start or block_header.latest_block_little != tip_start:
+		block_header.save_header_cache(block_header.headers_consumed,
+									block_header.get_last_header_hash(BLOCK_HEADERS_FILENAME,
+																	block_header.headers_consumed))
+
+	return True
+
+
+def get_wallet_block(session, block_hash):
+	# raw block of a block hash (raw little endian) from the full node proxy, or None
+	response = session.get(FULL_NODE_PROXY_URL + "/block?" + block_hash[::-1].encode('hex_codec'))
+
+	# check status code
+	if response.status_code != 200:
+		return None
+
+	# header must be the one of the block hash
+	block_data = response.content
+	if hashlib.sha256(hashlib.sha256(block_data[0: 80]).digest()).digest() != block_hash:
+		return None
+
+	return block_data
+
+
+def find_block_transactions(block_data, script_keys, outpoint_keys):
+	# (raw little endian tx hash, outpoints it pays to the wallet) of every transaction of a block
+	# paying to a script key or spending an outpoint key, None if the block does not match its header
+	# keys are the script index keys of the wallet's output scripts and outpoints
+	found = []
+	tx_hashes = []
+
+	try:
+		# transaction count
+		tx_count, num_byte_parsed = blockchain.parse_var_len_int(block_data, 80)
+		nth_byte = 80 + num_byte_parsed
+
+		for i in xrange(0, tx_count):
+			# keys of output scripts and spent outpoints of this transaction, (key, tx_index, io_index)
+			entries = []
+			tx_hash, nth_byte = blockchain.parse_transaction(block_data, nth_byte, i, None, entries)
+			tx_hashes += [tx_hash]
+
+			# outputs paying to the wallet, and inputs spending from it
+			outpoints = [tx_hash + struct.pack("<I", io_index)
+						for key, tx_index, io_index in entries if key in script_keys]
+			if len(outpoints) > 0 or any(key in outpoint_keys for key, tx_index, io_index in entries):
+				found += [(tx_hash, outpoints)]
+	except (AssertionError, struct.error, IndexError):
+		return None
+
+	# transactions must be exactly the ones the header commits to
+	if nth_byte != len(block_data) or blockchain.get_merkle_root(b"".join(tx_hashes)) != block_data[36: 68]:
+		return None
+
+	return found
+
+
+def find_wallet_transactions(session, scripts, start_row=0):
+	# scan block filters from the nth block for transactions paying to or spending from output scripts
+	# a matched block is downloaded and checked against its header, outputs paid to the scripts
+	# are watched from then on so the transactions spending them are found too
+	# returns (raw little endian tx hash, message, confirmations) of every transaction, or None
+	script_keys = set([script_index.get_script_key(script) for script in scripts])
+	outpoint_keys = set()
+
+	# filter items of the wallet, its output scripts and the outpoints paid to them
+	items = list(scripts)
+	results = []
+
+	while True:
+		response = session.get(FULL_NODE_PROXY_URL + "/filters", params={"start": start_row})
+
+		# check status code
+		if response.status_code == 404:
+			print("  Full node proxy does not build block filters.")
+			return None
+		if response.status_code != 200:
+			print("  Cannot reach full node proxy.")
+			return None
+
+		records = block_filter.parse_filter_records(response.content)
+		if len(records) == 0:
+			break
+
+		for block_hash, filter_data in records:
+			# only blocks of the main chain are of interest
+			header = block_header.get_header(block_hash)
+			if header is None or header.get_main_chain() == False:
+				continue
+
+			if not block_filter.match_filter(filter_data, block_hash, items):
+				continue
+
+			# filters give false positives, the block itself tells
+			block_data = get_wallet_block(session, block_hash)
+			found = find_block_transactions(block_data, script_keys, outpoint_keys) if block_data is not None else None
+			if found is None:
+				print("  Block " + header.get_curr_hash_big() + " cannot be verified.")
+				continue
+
+			for tx_hash, outpoints in found:
+				message, confirmations = block_header.get_confirmations(header)
+				results += [(tx_hash, message, confirmations)]
+
+				# transactions spending these outputs are in later blocks
+				for outpoint in outpoints:
+					outpoint_keys.add(script_index.get_outpoint_key(outpoint))
+					items += [outpoint]
+
+		start_row += len(records)
+
+	return results
+
+
+def find_script_transactions(session, script):
+	# verify every transaction paying to or spending from an output script
+	# returns (raw little endian tx hash, message, confirmations) of every transaction, or None
+	response = session.get(FULL_NODE_PROXY_URL + "/script?" + script.encode('hex_codec'))
+
+	# check status code
+	if response.status_code == 404:
+		print("  Full node proxy does not build the script index.")
+		return None
+	if response.status_code != 200:
+		print("  Cannot reach full node proxy.")
+		return None
+
+	# txid count | txids | merkle proofs
+	data = response.content
+	tx_count = struct.unpack_from("<I", data, 0)[0]
+	tx_hashes = [data[4 + i * 32: 4 + (i + 1) * 32] for i in xrange(0, tx_count)]
+
+	results = block_header.verify_transactions(tx_hashes, data[4 + tx_count * 32:])
+
+	return [(tx_hashes[i], results[i][0], results[i][1]) for i in xrange(0, tx_count)]
+
+
+def check_txid(txid):
+	# error message of a malformed big endian transaction ID, or None
+	# check if input length is 64
+	if len(txid) != 64:
+		return "Transaction ID shoud be 64 characters."
+
+	# check if input is proper hex string
+	# int() would also take a sign, a 0x prefix or spaces, which decode('hex') rejects
+	if not all(c in string.hexdigits for c in txid):
+		return "Transaction ID shoud be hexadecimal."
+
+	return None
+
+
+def read_txid_batches(txid_file):
+	# one txid per line, blank lines are skipped
+	txids = []
+	for line in txid_file:
+		txid = line.strip()
+		if txid == "":
+			continue
+
+		txids += [txid]
+		if len(txids) == BULK_BATCH_SIZE:
+			yield txids
+			txids = []
+
+	if len(txids) > 0:
+		yield txids
+
+	return
+
+
+def fetch_merkle_proofs(txids):
+	# each thread reuses its own keep-alive connection to the full node proxy
+	if not hasattr(thread_data, "session"):
+		thread_data.session = requests.Session()
+
+	# raw little endian hashes of well-formed txids
+	tx_hashes = [txid.decode('hex')[::-1] for txid in txids if check_txid(txid) is None]
+	if len(tx_hashes) == 0:
+		return txids, tx_hashes, None
+
+	# make POST request to full node proxy to retrieve merkle proofs of the batch
+	try:
+		response = thread_data.session.post(FULL_NODE_PROXY_URL + "/txids", data=b"".join(tx_hashes))
+	except requests.exceptions.RequestException:
+		return txids, tx_hashes, None
+
+	# check status code
+	if response.status_code != 200:
+		return txids, tx_hashes, None
+
+	return txids, tx_hashes, response.content
+
+
+def verify_bulk(txid_file, results_file):
+	# batches are fetched concurrently and verified in input order
+	pool = ThreadPool(BULK_CONCURRENCY)
+
+	for txids, tx_hashes, proofs_data in pool.imap(fetch_merkle_proofs, read_txid_batches(txid_file)):
+		# use merkle proofs to verify every transaction of the batch
+		if proofs_data is not None:
+			results = block_header.verify_transactions(tx_hashes, proofs_data)
+		else:
+			results = [("Cannot reach full node proxy.", -1)] * len(tx_hashes)
+
+		# one json line per txid
+		nth_result = 0
+		lines = []
+		for txid in txids:
+			message = check_txid(txid)
+			if message is None:
+				message, confirmations = results[nth_result]
+				nth_result += 1
+			else:
+				confirmations = -1
+
+			lines += [json.dumps({"txid": txid, "confirmations": confirmations, "message": message})]
+
+		results_file.write("\n".join(lines) + "\n")
+		results_file.flush()
+
+	pool.close()
+	pool.join()
+
+	return
 
 
 if __name__ == "__main__":
-	print("Fetch block headers from full node proxy..")
-	# TODO: run full node proxy first to let it parse all blocks
-	#       fetch the block headers generated by the proxy
-	#urllib.urlretrieve(FULL_NODE_PROXY_URL + "/blockheaders.dat", "blockheaders.dat")
+	# txids of a file, or "-" for stdin, are verified in bulk
+	bulk_filename = sys.argv[1] if len(sys.argv) > 1 else None
+	if bulk_filename is not None:
+		# progress goes to stderr so stdout only holds json lines
+		results_file = sys.stdout
+		sys.stdout = sys.stderr
+
+	# first run starts from an empty headers file
+	if not os.path.isfile(BLOCK_HEADERS_FILENAME):
+		open(BLOCK_HEADERS_FILENAME, "wb").close()
 
 	# spv client ready to parse block headers
 	print("SPV client is initializing...")
-	block_header.setup("blockheaders.dat")
+	block_header.setup(BLOCK_HEADERS_FILENAME)
 	print("Set up done.")
 
+	# reuse one keep-alive connection to the full node proxy
+	session = requests.Session()
+
+	# fetch block headers the full node proxy parsed since the last run
+	print("Fetch block headers from full node proxy..")
+	sync_headers(session)
+	last_sync_time = time.time()
+	print("Block headers are up to date.")
+
+	# verify every txid of the file and exit
+	if bulk_filename is not None:
+		txid_file = sys.stdin if bulk_filename == "-" else open(bulk_filename, "r")
+		verify_bulk(txid_file, results_file)
+		txid_file.close()
+		sys.exit(0)
+
 	# use SPV protocol to verify bitcoin transaction
 	while True:
 		print("\n- Please enter a transaction ID to verify the Bitcoin transaction...")
+		print("  (or scan followed by a hex output script to find its transactions with block filters,")
+		print("  or script followed by a hex output script to look them up in the proxy's script index)")
 		# big endian transaction ID
 		txid = raw_input("> ")
 
-		# check if input length is 64
-		if len(txid) != 64:
-			print("  Transaction ID shoud be 64 characters.")
+		# find transactions of an output script, with block filters so the proxy does not learn
+		# the script, or with the proxy's script index in one request
+		command, _, script_hex = txid.partition(" ")
+		if command in ("scan", "script"):
+			try:
+				script = script_hex.strip().decode('hex')
+			except TypeError:
+				print("  Output script should be hexadecimal.")
+				continue
+
+			if len(script) == 0:
+				print("  Output script should not be empty.")
+				continue
+
+			# pick up new blocks so confirmations are current
+			if time.time() - last_sync_time >= HEADER_SYNC_INTERVAL:
+				sync_headers(session)
+				last_sync_time = time.time()
+
+			if command == "scan":
+				results = find_wallet_transactions(session, [script])
+			else:
+				results = find_script_transactions(session, script)
+			if results is None:
+				continue
+
+			print("  Transactions: " + str(len(results)))
+			for tx_hash, message, confirmations in results:
+				print("  " + tx_hash[::-1].encode('hex_codec') + " Confirmations: " + str(confirmations))
+				print("    " + message)
+			continue
+
+		# check if input is a well-formed transaction ID
+		message = check_txid(txid)
+		if message is not None:
+			print("  " + message)
 			continue
 
-		# check if input is proper hex string
-		try:
-			int(txid, 16)
-		except ValueError:
-			print("  Transaction ID shoud be hexadecimal.")
+		# pick up new blocks so confirmations are current
+		if time.time() - last_sync_time >= HEADER_SYNC_INTERVAL:
+			sync_headers(session)
+			last_sync_time = time.time()
+
+		# raw little endian transaction hash
+		tx_hash = txid.decode('hex')[::-1]
+
+		# already verified transaction only needs its confirmations from the current tip
+		cached_result = block_header.get_cached_confirmations(tx_hash)
+		if cached_result is not None:
+			message, confirmations = cached_result
+			print("  Confirmations: " + str(confirmations))
+			print("  " + message)
 			continue
 
 		# make GET request to full node proxy to retrieve merkle branches
-		#response = requests.get(FULL_NODE_PROXY_URL + "/txid?" + txid)
-		response = requests.get("http://127.0.0.1:9000" + "/txid?" + txid)
+		response = session.get(FULL_NODE_PROXY_URL + "/txid?" + txid)
 
 		# check status code
 		if response.status_code != 200:
@@ -56,11 +424,12 @@ if __name__ == "__main__":
 		merkle_response = response.json()
 		tx_count = int(merkle_response["tx_count"])
 		tx_leaf_index = int(merkle_response["tx_leaf_index"])
-		tx_branch_hashes = merkle_response["tx_branch_hashes"]
-		tx_root_hash = merkle_response["tx_root_hash"]
+		# little endian hex strings to raw hashes
+		tx_branch_hashes = [str(branch).decode('hex') for branch in merkle_response["tx_branch_hashes"]]
+		tx_root_hash = str(merkle_response["tx_root_hash"]).decode('hex')
 
 		# use merkle branches to recontruct merkle tree to verify transaction hash
-		message, confirmations = block_header.verify_transaction(txid, tx_count, tx_leaf_index,
+		message, confirmations = block_header.verify_transaction(tx_hash, tx_count, tx_leaf_index,
 																tx_branch_hashes, tx_root_hash)
 
 
@@ -0,0 +1,45 @@
+# tx_index.py
+# Persistent on-disk index of transaction hashes to block header hashes
+#
+# HingOn Miu
+
+# The index is a record file (see record_file.py) of fixed-width records sorted by transaction hash:
+#   tx_hash (32 bytes little endian) | block_hash (32 bytes little endian) | tx_index (4 bytes little endian)
+
+import struct
+import record_file
+
+
+# bytes of each record
+RECORD_SIZE = 32 + 32 + 4
+
+# on-disk records, keyed by transaction hash
+index = record_file.RecordFile(RECORD_SIZE, 32)
+
+
+def pack_record(tx_hash, block_hash, tx_index):
+	# tx_hash | block_hash | tx_index
+	return tx_hash + block_hash + struct.pack("<I", tx_index)
+
+
+def unpack_record(record):
+	# block_hash, tx_index
+	return record[32:64], struct.unpack("<I", record[64:68])[0]
+
+
+def pack_records(tx_hash_to_block_hash):
+	# sorted records of an in-memory index
+	for tx_hash in sorted(tx_hash_to_block_hash):
+		block_hash, tx_index = tx_hash_to_block_hash[tx_hash]
+		yield pack_record(tx_hash, block_hash, tx_index)
+
+	return
+
+
+def lookup(tx_hash):
+	# (block_hash, tx_index) of a transaction, None if it is not in the index
+	record = index.lookup(tx_hash)
+	if record is None:
+		return None
+
+	return unpack_record(record)